@@ -1,14 +1,17 @@
+import asyncio
+import collections.abc as cabc
 import dataclasses
 import functools
 import os
 import sys
+import tomllib
 import typing
 
 import attr
 import cattr
 import structlog
 
-from . import di, util
+from . import context, di, util
 
 logger = structlog.get_logger()
 
@@ -28,36 +31,432 @@ class ConfigSource(dict):
     FooConfig(bar=1.23)
     """
 
-    __slots__ = ("env_prefix",)
+    __slots__ = (
+        "env_prefix",
+        "applied_env",
+        "_configs",
+        "_env",
+        "_env_names",
+        "_lazy",
+    )
 
     def __init__(self, *sources, env_prefix: typing.Optional[str] = None):
         super().__init__()
-        util.merge_dict(*sources, dest=self)
+        self._configs: dict = {}
+        self._env: typing.Optional[EnvIndex] = None
+        self._env_names: typing.Set[str] = set()
+        self._lazy: typing.Dict[str, typing.List[typing.Callable]] = {}
+        self.applied_env: typing.Dict[str, typing.Tuple[str, ...]] = {}
+        self._merge(sources)
         # config = schematize(__source, cls, env_prefix=env_prefix)
 
         self.env_prefix: typing.Tuple[str, ...] = (env_prefix,) if env_prefix else ()
 
+    def invalidate(self, *sections):
+        """Invalidate loaded configs of `sections` or all.
+
+        Changes via the dict API of the source itself invalidate on their own,
+        but nested changes in place must be made by :py:obj:`merge` or be
+        followed by an explicit invalidation.
+        """
+        if not sections:
+            self._configs.clear()
+            return
+        for key in list(self._configs):
+            _, name = key
+            # INFO: a config without section depends on the whole source
+            if name is None or name in sections:
+                del self._configs[key]
+
+    def __setitem__(self, key, value):
+        self._lazy.pop(key, None)
+        super().__setitem__(key, value)
+        self.invalidate()
+
+    def __delitem__(self, key):
+        if self._lazy.pop(key, None) is not None and not super().__contains__(key):
+            self.invalidate()
+            return
+        super().__delitem__(key)
+        self.invalidate()
+
+    def setdefault(self, key, default=None):
+        # INFO: the section may be altered in place, e.g. by util.merge_dict
+        self.invalidate(key)
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.invalidate()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self.invalidate()
+        return value
+
+    def clear(self):
+        super().clear()
+        self.invalidate()
+
+    def _merge(self, sources):
+        for source in sources:
+            if isinstance(source, LazySource):
+                for section, loads in source.sections.items():
+                    self._lazy.setdefault(section, []).extend(loads)
+            else:
+                util.merge_dict(source, dest=self)
+                # INFO: a later source wins over a pending lazy section
+                for section, layers in self._lazy.items():
+                    if section in source:
+                        layers.append(source[section])
+
     def merge(self, *sources):
-        util.merge_dict(*sources, dest=self)
+        self._merge(sources)
+        self.invalidate()
+
+    def resolve(self, *sections: str):
+        """Load the pending lazy `sections` or all.
+
+        A lazy section is merged in the order of the sources, so that the
+        sources following the lazy one still win.
+        """
+        for section in sections or list(self._lazy):
+            layers = self._lazy.pop(section, None)
+            if layers:
+                logger.debug("Loading lazy config section", section=section)
+                util.merge_dict(
+                    *(
+                        layer if isinstance(layer, cabc.Mapping) else layer()
+                        for layer in layers
+                    ),
+                    dest=dict.setdefault(self, section, {}),
+                )
+                self.invalidate(section)
+
+    def __getitem__(self, key):
+        if key in self._lazy:
+            self.resolve(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        if key in self._lazy:
+            self.resolve(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        return key in self._lazy or super().__contains__(key)
+
+    def _pending(self) -> typing.List[str]:
+        return [key for key in self._lazy if not dict.__contains__(self, key)]
+
+    def __iter__(self):
+        # INFO: a snapshot, since accessing a lazy section resolves it
+        return iter([*super().__iter__(), *self._pending()])
+
+    def __len__(self):
+        return super().__len__() + len(self._pending())
+
+    def keys(self):
+        """All sections, including the pending lazy ones."""
+        return cabc.KeysView(self)
+
+    def items(self):
+        """All sections, a lazy one is resolved on access."""
+        return cabc.ItemsView(self)
+
+    def values(self):
+        """All sections, a lazy one is resolved on access."""
+        return cabc.ValuesView(self)
+
+    def replace(self, *sources) -> typing.Set[str]:
+        """Replace all values by the merged `sources`.
+
+        Only loaded configs of changed sections are invalidated.
+
+        :returns: the changed sections
+        """
+        values = util.merge_dict(*sources)
+        changed = {
+            key
+            for key in self.keys() | values.keys()
+            if key not in self or key not in values or self[key] != values[key]
+        }
+        self._lazy.clear()
+        dict.clear(self)
+        dict.update(self, values)
+        if changed:
+            self.invalidate(*changed)
+        return changed
+
+    @property
+    def env(self) -> "EnvIndex":
+        """The snapshot of the environment vars matching the env prefix.
+
+        The snapshot is taken once and only renewed by :py:obj:`refresh_env`
+        or if `os.environ` is replaced, so that a load does not scan the
+        whole environment.
+        """
+        if self._env is None or self._env.environ is not os.environ:
+            self._env = EnvIndex(prefixes=self.env_prefix)
+        return self._env
+
+    def refresh_env(self):
+        """Take a new snapshot of the environment on the next load, e.g. after
+        `os.environ` was changed in place."""
+        self._env = None
+
+    def unmatched_env(self) -> typing.Set[str]:
+        """Return all env vars with our prefix, which matched no loaded field."""
+        return {
+            name
+            for name, _ in self.env.find(*self.env_prefix)
+            if name not in self._env_names
+        }
 
     def load(self, config_cls, name=None):
+        """Load a config section.
+
+        The config is cached until the section is invalidated, see
+        :py:obj:`invalidate`, or the env snapshot changes, see :py:obj:`env`.
+        The cached instance is shared by all callers and must not be altered.
+        """
+        if self._lazy:
+            self.resolve(*((name,) if name else ()))
+        loader = compile_config_loader(
+            config_cls, self.env_prefix + ((name,) if name else ())
+        )
+        env_values = loader.env_values(self.env)
+        self._env_names.update(loader.paths)
+        key = (config_cls, name)
+        try:
+            cached_env_values, config = self._configs[key]
+            if cached_env_values == env_values:
+                return config
+        except KeyError:
+            pass
+
         if name is None:
             values = self
         else:
             values = self.get(name, {})
 
-        env_config = create_env_config(
-            config_cls, *(self.env_prefix + ((name,) if name else ()))
-        )
-        values = util.merge_dict(values, env_config)
         # merge environment
+        values = util.merged(values, loader.env_config(env_values))
+        for env_name, _ in env_values:
+            self.applied_env[env_name] = loader.paths[env_name]
 
         # FIXME: use pydantic only
         # this will sacrifice pure dataclass usage... hmmmm...
         config = relaxed_converter.structure(values, config_cls)
+        self._configs[key] = (env_values, config)
         return config
 
 
+class LazySource:
+    """Config sections, which are not loaded until they are requested.
+
+    .. code-block:: python
+
+        source = ConfigSource({"foo": {"bar": 1}}, load_config_dir("conf.d"))
+    """
+
+    def __init__(self):
+        self.sections: typing.Dict[str, typing.List[typing.Callable]] = {}
+
+    def add(self, section: str, load: typing.Callable[[], typing.Mapping]):
+        self.sections.setdefault(section, []).append(load)
+
+
+def load_toml(path: str) -> typing.Dict[str, typing.Any]:
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+try:
+    import orjson
+
+    def load_json(path: str) -> typing.Dict[str, typing.Any]:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+
+except ImportError:
+    import json
+
+    def load_json(path: str) -> typing.Dict[str, typing.Any]:
+        with open(path, "rb") as f:
+            return json.load(f)
+
+
+def load_yaml(path: str) -> typing.Dict[str, typing.Any]:
+    try:
+        import yaml
+    except ImportError as ex:
+        raise ConfigError("Loading YAML requires PyYAML", path) from ex
+
+    with open(path, "rb") as f:
+        return yaml.safe_load(f) or {}
+
+
+CONFIG_FILE_LOADERS: typing.Dict[str, typing.Callable[[str], typing.Mapping]] = {
+    ".toml": load_toml,
+    ".json": load_json,
+    ".yaml": load_yaml,
+    ".yml": load_yaml,
+}
+
+
+def load_config_file(path: str) -> typing.Mapping:
+    """Load a config file by the loader registered for its extension."""
+    _, ext = os.path.splitext(path)
+    try:
+        load = CONFIG_FILE_LOADERS[ext.lower()]
+    except KeyError:
+        raise ConfigError(f"No config loader for: {path}", path)
+    return load(path)
+
+
+def load_config_dir(path: str) -> LazySource:
+    """Load a directory of config fragments lazily.
+
+    Every fragment contains a single section, which is named by the fragment
+    file name without extension and without an optional ordering prefix,
+    e.g. `10-routing.json`. Fragments of the same section are merged in the
+    numeric order of their prefixes, fragments without a prefix last and in
+    the order of their file names.
+    """
+    fragments = []
+    for name in os.listdir(path):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in CONFIG_FILE_LOADERS:
+            continue
+        prefix, sep, section = stem.partition("-")
+        if sep and prefix.isdigit():
+            order = (0, int(prefix))
+        else:
+            order, section = (1, 0), stem
+        fragments.append((order, name, section))
+
+    source = LazySource()
+    for _, name, section in sorted(fragments):
+        source.add(
+            section, functools.partial(load_config_file, os.path.join(path, name))
+        )
+    return source
+
+
+class ReloadableConfigSource(ConfigSource):
+    """A config source merged from files, which may be reloaded on change.
+
+    Subscribers are notified for every changed section, subscribers of the
+    `None` section for any change.
+
+    .. code-block:: python
+
+        async def prepare(cancel: plugin.Cancel):
+            source = context.add(ReloadableConfigSource("config.toml"))
+            source.publish()
+            yield source.watch(cancel=cancel)
+    """
+
+    __slots__ = ("paths", "defaults", "load_file", "_mtimes", "_subscribers")
+
+    def __init__(
+        self,
+        *paths: str,
+        defaults: typing.Sequence[typing.Mapping] = (),
+        env_prefix: typing.Optional[str] = None,
+        load_file: typing.Callable[[str], typing.Mapping] = load_config_file,
+    ):
+        super().__init__(env_prefix=env_prefix)
+        self.paths = paths
+        self.defaults = defaults
+        self.load_file = load_file
+        self._subscribers: typing.Dict[
+            typing.Optional[str], typing.List[typing.Callable]
+        ] = {}
+        self._mtimes = self.mtimes()
+        self.replace(*self.defaults, *self.read())
+
+    def mtimes(self) -> typing.Tuple[typing.Optional[int], ...]:
+        def _mtime(path):
+            try:
+                return os.stat(path).st_mtime_ns
+            except OSError:
+                return None
+
+        return tuple(map(_mtime, self.paths))
+
+    def read(self) -> typing.List[typing.Mapping]:
+        return [self.load_file(path) for path in self.paths if os.path.exists(path)]
+
+    def subscribe(
+        self,
+        section: typing.Optional[str],
+        callback: typing.Callable[
+            ["ReloadableConfigSource", typing.Optional[str]], None
+        ],
+    ):
+        self._subscribers.setdefault(section, []).append(callback)
+
+    def reload(self) -> typing.Set[str]:
+        """Reload all files and notify subscribers of changed sections."""
+        self._mtimes = self.mtimes()
+        self.refresh_env()
+        try:
+            sources = self.read()
+        except Exception as ex:
+            logger.error("Config reload failed", paths=self.paths, exc_info=ex)
+            return set()
+
+        changed = self.replace(*self.defaults, *sources)
+        if changed:
+            logger.info("Config changed", sections=sorted(changed))
+            for section in (*changed, None):
+                for callback in self._subscribers.get(section, ()):
+                    try:
+                        callback(self, section)
+                    except Exception as ex:
+                        logger.error(
+                            "Config subscriber failed", section=section, exc_info=ex
+                        )
+        return changed
+
+    def check(self) -> typing.Set[str]:
+        """Reload, if a file changed."""
+        if self.mtimes() != self._mtimes:
+            return self.reload()
+        return set()
+
+    async def watch(
+        self, interval: float = 1.0, *, cancel: typing.Optional[asyncio.Event] = None
+    ):
+        """Poll the files for changes until `cancel` is set."""
+        if cancel is None:
+            cancel = asyncio.Event()
+        while not cancel.is_set():
+            self.check()
+            try:
+                await asyncio.wait_for(cancel.wait(), interval)
+            except TimeoutError:
+                pass
+
+    def publish(self, cmps=None):
+        """Add all present :py:obj:`Config` sections to the components and
+        replace them, if their section changes."""
+        if cmps is None:
+            cmps = context.current_context()
+
+        def _publish(source, section):
+            config_cls = Config.__buvar_config_sections__.get(section)
+            if config_cls is not None:
+                cmps.add(source.load(config_cls, section))
+
+        for section in Config.__buvar_config_sections__:
+            if section is None or section in self:
+                _publish(self, section)
+            self.subscribe(section, _publish)
+
+
 class ConfigError(Exception): ...
 
 
@@ -108,6 +507,14 @@ def has(field):
 def traverse_attrs(cls, *, target=None, get_type_hints=typing.get_type_hints):
     """Traverse a nested attrs structure, create a dictionary for each nested
     attrs class and yield all fields resp. path, type and target dictionary."""
+    for path, field_type, target, _ in traverse_fields(
+        cls, target=target, get_type_hints=get_type_hints
+    ):
+        yield path, field_type, target
+
+
+def traverse_fields(cls, *, target=None, get_type_hints=typing.get_type_hints):
+    """Like :py:obj:`traverse_attrs` but also yield the field itself."""
     stack = [
         (
             target if target is not None else {},
@@ -120,13 +527,16 @@ def traverse_attrs(cls, *, target=None, get_type_hints=typing.get_type_hints):
         target, path, fields, hints = stack.pop()
         while fields:
             field = fields.pop()
+            if field.init is False:
+                # INFO: the field cannot be configured
+                continue
             # logger.debug("traverse field", field=field)
             field_path = path + (field.name,)
             field_type = hints[field.name]
             if has(field_type):
                 target[field.name] = field_target = {}
                 # XXX should we yield also attrs classes?
-                yield field_path, field_type, target
+                yield field_path, field_type, target, field
 
                 stack.append((target, path, fields, hints))
                 target, path, fields, hints = (
@@ -136,7 +546,7 @@ def traverse_attrs(cls, *, target=None, get_type_hints=typing.get_type_hints):
                     get_type_hints(field_type),
                 )
             else:
-                yield field_path, field_type, target
+                yield field_path, field_type, target, field
 
 
 def create_env_config(cls, *env_prefix):
@@ -150,13 +560,167 @@ def create_env_config(cls, *env_prefix):
         cls, target=env_config, get_type_hints=get_type_hints
     ):
         env_name = "_".join(map(lambda x: x.upper(), env_prefix + path))
-        logger.debug("Read env", var=env_name)
         if env_name in os.environ:
             logger.debug("Overriding config by env", var=env_name)
             target[path[-1]] = os.environ[env_name]
     return env_config
 
 
+class EnvIndex:
+    """A snapshot of environment vars, indexed by a trie of their `_`
+    separated name tokens.
+
+    The snapshot is not updated, if `environ` changes afterwards.
+    """
+
+    def __init__(
+        self,
+        environ: typing.Optional[typing.Mapping[str, str]] = None,
+        *,
+        prefixes: typing.Iterable[str] = (),
+    ):
+        self.environ = os.environ if environ is None else environ
+        self.prefixes = tuple(prefix.upper() for prefix in prefixes)
+        self.root: typing.Dict[typing.Optional[str], typing.Any] = {}
+        for name, value in self.environ.items():
+            if self.prefixes and not any(
+                name == prefix or name.startswith(f"{prefix}_")
+                for prefix in self.prefixes
+            ):
+                continue
+            node = self.root
+            for token in name.split("_"):
+                node = node.setdefault(token, {})
+            # INFO: None marks the var itself
+            node[None] = (name, value)
+
+    def find(self, *prefix: str) -> typing.Iterator[typing.Tuple[str, str]]:
+        """Find all env vars starting with the prefix parts."""
+        node = self.root
+        for part in prefix:
+            for token in part.upper().split("_"):
+                node = node.get(token)
+                if node is None:
+                    return
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for token, child in node.items():
+                if token is None:
+                    yield child
+                else:
+                    stack.append(child)
+
+
+@dataclasses.dataclass(frozen=True)
+class SchemaField:
+    """A compiled config field.
+
+    :param path: the path of the field within its section
+    :param env_name: the env var to override the field
+    :param default: the default value or :py:obj:`dataclasses.MISSING`
+    :param nested: the field is a nested config class
+    """
+
+    path: typing.Tuple[str, ...]
+    env_name: str
+    type: typing.Any
+    default: typing.Any = dataclasses.MISSING
+    nested: bool = False
+
+    @property
+    def required(self) -> bool:
+        return self.default is dataclasses.MISSING
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        data = {
+            "path": list(self.path),
+            "env": self.env_name,
+            "type": _type_name(self.type),
+            "required": self.required,
+        }
+        if not self.required:
+            data["default"] = self.default
+        return data
+
+
+def _field_default(field):
+    if isinstance(field, dataclasses.Field):
+        if field.default_factory is not dataclasses.MISSING:
+            return field.default_factory()
+        return field.default
+    default = field.default
+    if isinstance(default, attr.Factory):
+        # INFO: we have no instance to pass to the factory
+        return dataclasses.MISSING if default.takes_self else default.factory()
+    return dataclasses.MISSING if default is attr.NOTHING else default
+
+
+def _type_name(tp) -> str:
+    if isinstance(tp, type) and not typing.get_args(tp):
+        return tp.__qualname__
+    return repr(tp).replace("typing.", "")
+
+
+class ConfigLoader:
+    """A config class compiled for a certain env prefix.
+
+    The env var names and the nested structure are computed only once. The
+    structure hook is not, since hooks may be registered later on.
+    """
+
+    def __init__(self, cls, env_prefix: typing.Tuple[str, ...] = ()):
+        self.env_prefix = env_prefix
+        self.skeleton: typing.Dict[str, typing.Any] = {}
+        self.fields = tuple(
+            SchemaField(
+                path=path,
+                env_name="_".join(map(lambda x: x.upper(), env_prefix + path)),
+                type=field_type,
+                default=_field_default(field),
+                nested=has(field_type),
+            )
+            for path, field_type, _, field in traverse_fields(cls, target=self.skeleton)
+        )
+        self.paths = {field.env_name: field.path for field in self.fields}
+
+    def env_values(self, env: EnvIndex) -> typing.Tuple[typing.Tuple[str, str], ...]:
+        """Return all env vars of the snapshot, which match a field."""
+        return tuple(
+            sorted(
+                (name, value)
+                for name, value in env.find(*self.env_prefix)
+                if name in self.paths
+            )
+        )
+
+    def env_config(self, env_values) -> typing.Dict[str, typing.Any]:
+        env_config = _copy_tree(self.skeleton)
+        for env_name, value in env_values:
+            logger.debug("Overriding config by env", var=env_name)
+            path = self.paths[env_name]
+            target = env_config
+            for key in path[:-1]:
+                target = target.get(key)
+                if not isinstance(target, dict):
+                    break
+            else:
+                target[path[-1]] = value
+        return env_config
+
+
+def _copy_tree(tree):
+    return {
+        key: _copy_tree(value) if isinstance(value, dict) else value
+        for key, value in tree.items()
+    }
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_config_loader(cls, env_prefix: typing.Tuple[str, ...] = ()):
+    return ConfigLoader(cls, env_prefix)
+
+
 # FIXME: deprecate relaxed_converter
 converter = relaxed_converter = cattr.Converter()
 
@@ -182,12 +746,74 @@ def generate_env_help(cls, env_prefix=""):
     """Generate a list of all environment options."""
 
     help = "\n".join(  # noqa: W0622
-        "_".join((env_prefix,) + path if env_prefix else path).upper()
-        for path, type, _ in traverse_attrs(cls)
-        if not attr.has(type)
+        field.env_name
+        for field in compile_config_loader(
+            cls, (env_prefix,) if env_prefix else ()
+        ).fields
+        if not field.nested
     )
     return help
 
 
+class ConfigSchema:
+    """All registered :py:obj:`Config` sections compiled into one flat table.
+
+    The table is made of the same compiled loaders, which
+    :py:obj:`ConfigSource.load` uses to apply env overrides.
+
+    >>> @dataclasses.dataclass
+    ... class FooConfig:
+    ...     bar: int = 1
+    >>> schema = ConfigSchema({"foo": FooConfig}, env_prefix="APP")
+    >>> print(schema.env_help())
+    APP_FOO_BAR
+    >>> schema.dump(sys.stdout)  # doctest: +ELLIPSIS
+    [{"section": "foo", "path": ["bar"], "env": "APP_FOO_BAR", ..., "default": 1}]
+    """
+
+    def __init__(
+        self,
+        sections: typing.Optional[typing.Mapping[typing.Optional[str], type]] = None,
+        *,
+        env_prefix: typing.Optional[str] = None,
+    ):
+        if sections is None:
+            sections = Config.__buvar_config_sections__
+        prefix = (env_prefix,) if env_prefix else ()
+        self.loaders: typing.Dict[typing.Optional[str], ConfigLoader] = {
+            section: compile_config_loader(
+                cls, prefix + ((section,) if section else ())
+            )
+            for section, cls in sections.items()
+        }
+
+    @property
+    def fields(
+        self,
+    ) -> typing.Iterator[typing.Tuple[typing.Optional[str], SchemaField]]:
+        """Yield all section and field pairs."""
+        for section, loader in self.loaders.items():
+            for field in loader.fields:
+                yield section, field
+
+    def env_help(self) -> str:
+        """Generate a list of all environment options of all sections."""
+        return "\n".join(field.env_name for _, field in self.fields if not field.nested)
+
+    def to_list(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        return [
+            {"section": section, **field.to_dict()}
+            for section, field in self.fields
+            if not field.nested
+        ]
+
+    def dump(self, fp, **kwargs):
+        """Dump the schema as JSON, unserializable defaults are represented
+        by their `repr`."""
+        import json
+
+        json.dump(self.to_list(), fp, default=repr, **kwargs)
+
+
 async def prepare():
     di.register(Config.adapt)
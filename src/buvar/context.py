@@ -46,8 +46,12 @@ class StackingTaskFactory:
             def _push_context():
                 buvar_context.set(push())
 
-            task_ctx = contextvars.copy_context()
-            task_ctx.run(_push_context)
+            # INFO: an explicit context is used as is
+            if context is None:
+                task_ctx = contextvars.copy_context()
+                task_ctx.run(_push_context)
+            else:
+                task_ctx = context
 
             task = (
                 self.parent_factory
@@ -1,9 +1,21 @@
 import abc
+import asyncio
 import contextlib
+import dataclasses as dc
+import errno
+import fcntl
+import gc
+import math
+import mmap
 import os
-import queue
+import pickle
+import select
 import signal
 import socket
+import stat
+import struct
+import threading
+import time
 import typing as t
 
 import structlog
@@ -11,6 +23,7 @@ import uritools
 
 from buvar import plugin
 from buvar.components import Components
+from buvar.loop import configured_loop_factory
 
 sl = structlog.get_logger()
 URI = uritools.SplitResult
@@ -18,9 +31,103 @@ URI = uritools.SplitResult
 SocketArgs = t.Optional[t.Tuple[t.Any, ...]]
 
 
+SO_INCOMING_CPU: t.Optional[int] = getattr(socket, "SO_INCOMING_CPU", None)
+
+
+def worker_cpu(worker: int) -> int:
+    """Return the CPU a worker is assigned to."""
+    cpus = sorted(os.sched_getaffinity(0))
+    return cpus[worker % len(cpus)]
+
+
+def parse_cpulist(cpulist: str) -> t.Set[int]:
+    """Parse a kernel cpu list like `0-3,8`."""
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+NUMA_NODES_PATH = "/sys/devices/system/node"
+
+
+def numa_nodes(path: str = NUMA_NODES_PATH) -> t.List[t.Set[int]]:
+    """Return the CPUs of every NUMA node."""
+    nodes = []
+    try:
+        names = sorted(
+            (
+                name
+                for name in os.listdir(path)
+                if name.startswith("node") and name[4:].isdigit()
+            ),
+            key=lambda name: int(name[4:]),
+        )
+    except OSError:
+        return nodes
+    for name in names:
+        with open(os.path.join(path, name, "cpulist")) as f:
+            nodes.append(parse_cpulist(f.read()))
+    return nodes
+
+
+def cpu_affinity(
+    affinity: t.Union[str, t.Callable[[int, t.List[int]], t.Set[int]]],
+    worker: int,
+    cpus: t.Sequence[int],
+) -> t.Set[int]:
+    """Assign `cpus` to a `worker`.
+
+    :param affinity: `cpu` assigns a single CPU, `node` all CPUs of a NUMA
+        node or a callable, which returns the CPUs for a worker and all CPUs
+    """
+    cpus = sorted(cpus)
+    if callable(affinity):
+        return set(affinity(worker, cpus))
+    if affinity == "cpu":
+        return {cpus[worker % len(cpus)]}
+    if affinity == "node":
+        nodes = [node & set(cpus) for node in numa_nodes()]
+        nodes = [node for node in nodes if node]
+        if not nodes:
+            return set(cpus)
+        return nodes[worker % len(nodes)]
+    raise ValueError(f"Unknown CPU affinity: {affinity}", affinity)
+
+
+def _option_int(value: str) -> int:
+    value = value.strip().lower()
+    if value in ("true", "yes", "on"):
+        return 1
+    if value in ("false", "no", "off"):
+        return 0
+    return int(value)
+
+
 class Socket(socket.socket, metaclass=abc.ABCMeta):
+    """A socket described by an URI.
+
+    The URI query may contain socket options, e.g.
+    `tcp://:8080?backlog=4096&nodelay=1&fastopen=256`.
+
+    :param backlog: the listen backlog, the socket listens right after bind
+    :param rcvbuf: `SO_RCVBUF`
+    :param sndbuf: `SO_SNDBUF`
+    """
+
     __impls__ = set()
 
+    # option -> level and option name, which are set before bind
+    sockopts: t.Dict[str, t.Tuple[int, t.Optional[int]]] = {
+        "rcvbuf": (socket.SOL_SOCKET, socket.SO_RCVBUF),
+        "sndbuf": (socket.SOL_SOCKET, socket.SO_SNDBUF),
+    }
+    # options, which are handled otherwise
+    extra_options: t.FrozenSet[str] = frozenset(("backlog",))
+
     def __new__(cls, ref: str) -> "Socket":
         parts: URI = uritools.urisplit(ref)
         for impl_cls in cls.__impls__:
@@ -36,9 +143,13 @@ class Socket(socket.socket, metaclass=abc.ABCMeta):
 
     def __init__(self, uri):
         super().__init__(*self.args)
+        unknown = self.options.keys() - self.sockopts.keys() - self.extra_options
+        if unknown:
+            raise ValueError(f"Unknown socket options: {sorted(unknown)}", uri)
 
-    def __init_subclass__(cls) -> None:
-        cls.__impls__.add(cls)
+    def __init_subclass__(cls, register: bool = True) -> None:
+        if register:
+            cls.__impls__.add(cls)
 
     @abc.abstractmethod
     def bind(cls):
@@ -48,6 +159,50 @@ class Socket(socket.socket, metaclass=abc.ABCMeta):
     def create(cls, uri: URI) -> SocketArgs:
         ...
 
+    @property
+    def options(self) -> t.Dict[str, str]:
+        """The socket options of the URI query."""
+        return {key: values[-1] for key, values in self.uri.getquerydict().items()}
+
+    def flag(self, name: str) -> bool:
+        return bool(_option_int(self.options.get(name, "0")))
+
+    @property
+    def backlog(self) -> t.Optional[int]:
+        backlog = self.options.get("backlog")
+        return None if backlog is None else int(backlog)
+
+    def configure(self):
+        """Set the socket options before bind."""
+        for name, value in self.options.items():
+            if name not in self.sockopts:
+                continue
+            level, optname = self.sockopts[name]
+            if optname is None:
+                sl.warning("Socket option not supported", option=name, socket=self)
+                continue
+            self.setsockopt(level, optname, _option_int(value))
+
+    def listen(self, backlog: t.Optional[int] = None):
+        """Listen with the configured backlog, if there is one."""
+        backlog = self.backlog or backlog
+        if backlog is None:
+            super().listen()
+        else:
+            super().listen(backlog)
+
+    def listen_configured(self):
+        # INFO: servers may call listen again, which is fine
+        if self.backlog is not None:
+            self.listen()
+
+    def cleanup(self):
+        """Remove any leftovers of the socket after it was closed."""
+
+    def for_worker(self, worker: int) -> "Socket":
+        """Return the socket, a forked `worker` should use."""
+        return self
+
     def __hash__(self):
         return hash(self.uri)
 
@@ -58,20 +213,142 @@ class Socket(socket.socket, metaclass=abc.ABCMeta):
         return uritools.uriunsplit(self.uri)
 
 
-class TCPSocket(Socket):
+class InetSocket(Socket, register=False):
+    """An IP socket.
+
+    With `reuseport=1` every forked worker binds its own `SO_REUSEPORT` socket,
+    so that the kernel balances the connections between the workers.
+    `incoming_cpu=1` additionally hints the kernel to handle the connections
+    of a worker on the CPU the worker is assigned to.
+    """
+
+    scheme: str
+    socket_family = socket.AF_INET
+    socket_type = socket.SOCK_STREAM
+    any_host = "0.0.0.0"
+
+    sockopts = {
+        **Socket.sockopts,
+        "reuseport": (socket.SOL_SOCKET, getattr(socket, "SO_REUSEPORT", None)),
+    }
+    extra_options = Socket.extra_options | {"incoming_cpu"}
+
     @classmethod
     def create(cls, uri: URI) -> SocketArgs:
-        if uri.scheme == "tcp":
+        if uri.scheme == cls.scheme:
             if uri.gethost() == "":
-                uri = uri.transform(f"tcp://0.0.0.0:{uri.getport()}")
+                # INFO: keep the query
+                uri = uri._replace(authority=f"{cls.any_host}:{uri.getport()}")
 
-            return uri, socket.AF_INET, socket.SOCK_STREAM
+            return uri, cls.socket_family, cls.socket_type
 
-    def bind(self):
-        socket.socket.bind(self, (str(self.uri.gethost()), self.uri.getport()))
+    @property
+    def reuseport(self) -> bool:
+        return self.flag("reuseport")
+
+    def bind(self, address: t.Optional[t.Tuple[t.Any, ...]] = None):
+        self.configure()
+        if address is None:
+            address = (str(self.uri.gethost()), self.uri.getport())
+        socket.socket.bind(self, address)
+
+    def for_worker(self, worker: int) -> "Socket":
+        if not self.reuseport:
+            return self
+        # INFO: the parent only binds to reserve the address resp. an ephemeral
+        # port and never listens
+        sock = Socket(str(self))
+        if sock.flag("incoming_cpu"):
+            if SO_INCOMING_CPU is None:
+                sl.warning(
+                    "Socket option not supported", option="incoming_cpu", socket=sock
+                )
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU, worker_cpu(worker))
+        sock.bind(self.getsockname())
+        sock.listen_configured()
+        return sock
+
+
+class TCPSocket(InetSocket):
+    """A TCP socket.
+
+    :param nodelay: `TCP_NODELAY`, which is inherited by accepted connections
+    :param defer_accept: `TCP_DEFER_ACCEPT` in seconds
+    :param fastopen: the `TCP_FASTOPEN` queue length
+    """
+
+    scheme = "tcp"
+    sockopts = {
+        **InetSocket.sockopts,
+        "nodelay": (socket.IPPROTO_TCP, socket.TCP_NODELAY),
+        "defer_accept": (
+            socket.IPPROTO_TCP,
+            getattr(socket, "TCP_DEFER_ACCEPT", None),
+        ),
+        "fastopen": (socket.IPPROTO_TCP, getattr(socket, "TCP_FASTOPEN", None)),
+    }
+
+    def bind(self, address: t.Optional[t.Tuple[t.Any, ...]] = None):
+        super().bind(address)
+        # INFO: a parent never listens on a reuseport socket, see for_worker
+        if not self.reuseport:
+            self.listen_configured()
+
+
+class TCP6Socket(TCPSocket):
+    """An IPv6 TCP socket, which accepts also IPv4 connections, unless
+    `v6only=1`."""
+
+    scheme = "tcp6"
+    socket_family = socket.AF_INET6
+    any_host = "[::]"
+    sockopts = {
+        **TCPSocket.sockopts,
+        "v6only": (socket.IPPROTO_IPV6, socket.IPV6_V6ONLY),
+    }
+
+    def configure(self):
+        # INFO: be dual stack regardless of the system default
+        self.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        super().configure()
+
+
+class UDPSocket(InetSocket):
+    """An UDP datagram socket.
+
+    All forked workers read from the same socket. `reuseport` is not
+    supported, since the bound socket of the parent would be part of the
+    reuseport group and receive its share of the datagrams, which are never
+    read.
+    """
+
+    scheme = "udp"
+    socket_type = socket.SOCK_DGRAM
+    sockopts = Socket.sockopts
+    extra_options = frozenset()
+
+
+class UDP6Socket(UDPSocket):
+    """An IPv6 UDP datagram socket."""
+
+    scheme = "udp6"
+    socket_family = socket.AF_INET6
+    any_host = "[::]"
 
 
 class UnixSocket(Socket):
+    """A unix socket.
+
+    A stale socket file, which nobody listens on, is removed before bind and
+    the socket file is removed after the socket is closed. Any other file at
+    the path is never removed.
+
+    :param mode: the octal permissions of the socket file
+    """
+
+    extra_options = Socket.extra_options | {"mode"}
+
     @classmethod
     def create(cls, uri: URI) -> SocketArgs:
         if uri.scheme == "unix":
@@ -79,98 +356,967 @@ class UnixSocket(Socket):
             ...
             return uri, socket.AF_UNIX, socket.SOCK_STREAM
 
+    @property
+    def path(self) -> str:
+        return self.uri.getpath()
+
+    def remove_stale(self):
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(
+                errno.EEXIST, "Path exists and is not a socket", self.path
+            )
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            sl.info("Removing stale socket", path=self.path)
+            os.unlink(self.path)
+        except OSError:
+            pass
+        finally:
+            probe.close()
+
+    def bind(self):
+        self.configure()
+        self.remove_stale()
+        socket.socket.bind(self, self.path)
+        mode = self.options.get("mode")
+        if mode is not None:
+            os.chmod(self.path, int(mode, 8))
+        self.listen_configured()
+
+    def cleanup(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+SD_LISTEN_FDS_START = 3
+
+
+def listen_fds(
+    environ: t.Optional[t.Mapping[str, str]] = None,
+) -> t.Dict[str, int]:
+    """Return the names and descriptors passed by a process manager according
+    to the systemd `LISTEN_FDS` convention.
+
+    An unnamed descriptor is named by its number.
+    """
+    if environ is None:
+        environ = os.environ
+    if int(environ.get("LISTEN_PID", os.getpid())) != os.getpid():
+        return {}
+    count = int(environ.get("LISTEN_FDS", 0))
+    names = environ.get("LISTEN_FDNAMES", "").split(":")
+    fds = {}
+    for i, fd in enumerate(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count)):
+        name = names[i] if i < len(names) and names[i] else str(fd)
+        fds[name] = fd
+    return fds
+
+
+class FDSocket(Socket):
+    """Adopt an already bound descriptor, e.g. `fd://3` or by its name
+    `fd://web`, see :py:obj:`listen_fds`."""
+
+    extra_options = frozenset()
+
+    @classmethod
+    def create(cls, uri: URI) -> SocketArgs:
+        if uri.scheme == "fd":
+            name = uri.authority
+            fd = listen_fds().get(name)
+            if fd is None:
+                if not name.isdigit():
+                    raise ValueError(f"No descriptor passed for: {name}", name)
+                fd = int(name)
+            # INFO: family and type are detected from the descriptor
+            return uri, -1, -1, -1, fd
+
     def bind(self):
-        super().bind(self.uri.getpath())
+        # INFO: already bound
+        self.configure()
 
 
 class Sockets(dict):
     def __init__(self, *sockets: str):
         super().__init__((str(s), s) for s in map(Socket, sockets))
 
+    def for_worker(self, worker: int) -> "Sockets":
+        """Return the sockets of a forked `worker`.
+
+        Inherited sockets, which are replaced by a socket of the worker, are
+        closed.
+        """
+        sockets = Sockets()
+        for name, s in self.items():
+            sockets[name] = worker_socket = s.for_worker(worker)
+            if worker_socket is not s:
+                s.close()
+        return sockets
+
     @contextlib.contextmanager
     def bind(self):
         pid = os.getpid()
+        bound = []
         try:
             for s in self.values():
                 s.bind()
+                bound.append(s)
             yield self
         finally:
             if pid == os.getpid():
                 for s in self.values():
                     s.close()
+                for s in bound:
+                    s.cleanup()
+
+
+# signals forwarded to the children
+FORWARD_SIGNALS = (
+    signal.SIGINT,
+    signal.SIGTERM,
+    signal.SIGHUP,
+    signal.SIGQUIT,
+    signal.SIGABRT,
+    signal.SIGWINCH,
+    signal.SIGUSR1,
+    signal.SIGUSR2,
+)
+# signals, which shut down the workers for good
+STOP_SIGNALS = frozenset((signal.SIGINT, signal.SIGTERM, signal.SIGQUIT))
 
 
-class Fork:
+class Channel:
+    """A pipe from a child to its parent, which transports pickled messages.
+
+    Every message is a `(kind, data)` tuple prefixed by its length.
+    """
+
+    header = struct.Struct("!I")
+
+    def __init__(self):
+        self.reader, self.writer = os.pipe()
+        self._buffer = bytearray()
+
+    def close_reader(self):
+        if self.reader is not None:
+            os.close(self.reader)
+            self.reader = None
+
+    def close_writer(self):
+        if self.writer is not None:
+            os.close(self.writer)
+            self.writer = None
+
+    def send(self, kind: str, data: t.Any = None):
+        payload = pickle.dumps((kind, data), protocol=pickle.HIGHEST_PROTOCOL)
+        view = memoryview(self.header.pack(len(payload)) + payload)
+        while view:
+            view = view[os.write(self.writer, view) :]
+
+    def receive(self) -> t.Optional[t.List[t.Tuple[str, t.Any]]]:
+        """Read the available messages or return `None` at EOF."""
+        chunk = os.read(self.reader, 65536)
+        if not chunk:
+            return None
+        self._buffer += chunk
+        messages = []
+        size = self.header.size
+        while len(self._buffer) >= size:
+            (length,) = self.header.unpack_from(self._buffer)
+            if len(self._buffer) < size + length:
+                break
+            messages.append(pickle.loads(self._buffer[size : size + length]))
+            del self._buffer[: size + length]
+        return messages
+
+
+@dc.dataclass
+class WorkerStatus:
+    """The last reported status of a worker."""
+
+    pid: int
+    ready: bool = False
+    stats: t.Dict[str, t.Any] = dc.field(default_factory=dict)
+    updated: float = 0.0
+    cpus: t.Optional[t.Set[int]] = None
+
+
+def _rss() -> int:
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # INFO: the peak resident set size in KiB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _signal_name(signum: int) -> str:
+    try:
+        return signal.Signals(signum).name
+    except ValueError:
+        return str(signum)
+
+
+class SharedState:
+    """Counters, gauges and token buckets in shared memory.
+
+    The memory is mapped before forking, so all children update the same
+    values. Values are allocated by name on first use, so every child finds
+    the slot another one allocated. Updates are serialized by a record lock on
+    the backing file, which the kernel releases, if a child dies.
+
+        >>> state = SharedState()
+        >>> state.counter("requests").add()
+        1
+        >>> bucket = state.token_bucket("api", rate=10, capacity=20)
+        >>> bucket.acquire(5)
+        True
+    """
+
+    NAME_SIZE = 63
+    FREE, COUNTER, GAUGE, BUCKET, CONTINUED = b"\0cgb+"
+
+    def __init__(self, slots: int = 1024):
+        self.slots = slots
+        self.size = slots * (8 + 1 + self.NAME_SIZE)
+        if hasattr(os, "memfd_create"):
+            self.file = open(os.memfd_create("buvar-shared-state"), "r+b")
+        else:
+            import tempfile
+
+            self.file = tempfile.TemporaryFile()
+        self.file.truncate(self.size)
+        self.mmap = mmap.mmap(self.file.fileno(), self.size)
+        self.ints = memoryview(self.mmap)[: slots * 8].cast("q")
+        self.floats = memoryview(self.mmap)[: slots * 8].cast("d")
+        self.names = memoryview(self.mmap)[slots * 8 :]
+        self._lock = threading.Lock()
+        self._slots: t.Dict[str, t.Tuple[int, int]] = {}
+
+    @contextlib.contextmanager
+    def lock(self):
+        with self._lock:
+            fcntl.lockf(self.file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.file, fcntl.LOCK_UN)
+
+    def _entry(self, slot: int) -> memoryview:
+        start = slot * (1 + self.NAME_SIZE)
+        return self.names[start : start + 1 + self.NAME_SIZE]
+
+    def allocate(
+        self, name: str, kind: int, initial: t.Sequence[float] = (0.0,)
+    ) -> int:
+        """Find or allocate slots for `initial` values of `kind` named `name`."""
+        try:
+            found_kind, slot = self._slots[name]
+        except KeyError:
+            pass
+        else:
+            if found_kind != kind:
+                raise ValueError(f"Shared value `{name}` has another kind", name)
+            return slot
+
+        encoded = name.encode()
+        if not encoded or len(encoded) > self.NAME_SIZE:
+            raise ValueError(f"Invalid shared value name: {name}", name)
+        entry = bytes((kind,)) + encoded.ljust(self.NAME_SIZE, b"\0")
+        with self.lock():
+            slot = 0
+            while slot < self.slots:
+                current = self._entry(slot)
+                if current[0] == self.FREE:
+                    break
+                if current[1:] == entry[1:]:
+                    if current[0] != kind:
+                        raise ValueError(
+                            f"Shared value `{name}` has another kind", name
+                        )
+                    self._slots[name] = (kind, slot)
+                    return slot
+                slot += 1
+            if slot + len(initial) > self.slots:
+                raise ValueError("Shared state is full", self.slots)
+            # INFO: an integer zero and a float zero share their bits
+            for i, value in enumerate(initial):
+                self.floats[slot + i] = value
+                if i:
+                    self._entry(slot + i)[0] = self.CONTINUED
+            # INFO: the name is written last, so that a slot is initialized
+            self._entry(slot)[:] = entry
+        self._slots[name] = (kind, slot)
+        return slot
+
+    def counter(self, name: str) -> "SharedCounter":
+        return SharedCounter(self, self.allocate(name, self.COUNTER))
+
+    def gauge(self, name: str) -> "SharedGauge":
+        return SharedGauge(self, self.allocate(name, self.GAUGE))
+
+    def token_bucket(self, name: str, *, rate: float, capacity: float) -> "TokenBucket":
+        """Find or create the token bucket `name`.
+
+        The `rate` and `capacity` are stored with the bucket, so they must
+        match those of an existing bucket.
+        """
+        slot = self.allocate(
+            name, self.BUCKET, (capacity, time.monotonic(), rate, capacity)
+        )
+        bucket = TokenBucket(self, slot)
+        if (bucket.rate, bucket.capacity) != (rate, capacity):
+            raise ValueError(
+                f"Token bucket `{name}` has another rate or capacity",
+                name,
+                bucket.rate,
+                bucket.capacity,
+            )
+        return bucket
+
+    def values(self) -> t.Dict[str, t.Any]:
+        """Return the current value of all counters, gauges and buckets."""
+        values = {}
+        for slot in range(self.slots):
+            entry = self._entry(slot)
+            kind = entry[0]
+            if kind == self.FREE:
+                break
+            name = bytes(entry[1:]).rstrip(b"\0").decode()
+            if kind == self.COUNTER:
+                values[name] = self.ints[slot]
+            elif kind in (self.GAUGE, self.BUCKET):
+                values[name] = self.floats[slot]
+        return values
+
+    def close(self):
+        self.ints.release()
+        self.floats.release()
+        self.names.release()
+        self.mmap.close()
+        self.file.close()
+
+
+class SharedCounter:
+    """An integer, which is only incremented."""
+
+    def __init__(self, state: SharedState, slot: int):
+        self.state = state
+        self.slot = slot
+
+    @property
+    def value(self) -> int:
+        return self.state.ints[self.slot]
+
+    def add(self, value: int = 1) -> int:
+        with self.state.lock():
+            self.state.ints[self.slot] = result = self.state.ints[self.slot] + value
+        return result
+
+
+class SharedGauge:
+    """A float, which is set or adjusted."""
+
+    def __init__(self, state: SharedState, slot: int):
+        self.state = state
+        self.slot = slot
+
+    @property
+    def value(self) -> float:
+        return self.state.floats[self.slot]
+
+    def set(self, value: float):
+        with self.state.lock():
+            self.state.floats[self.slot] = value
+
+    def add(self, value: float) -> float:
+        with self.state.lock():
+            self.state.floats[self.slot] = result = self.state.floats[self.slot] + value
+        return result
+
+
+class TokenBucket:
+    """A rate limit shared by all workers.
+
+    Tokens are refilled by `rate` per second up to `capacity`. The bucket
+    occupies four slots: the tokens, the time of the last refill, the rate and
+    the capacity.
+    """
+
+    def __init__(self, state: SharedState, slot: int):
+        self.state = state
+        self.slot = slot
+
+    @property
+    def rate(self) -> float:
+        return self.state.floats[self.slot + 2]
+
+    @property
+    def capacity(self) -> float:
+        return self.state.floats[self.slot + 3]
+
+    def _refill(self, now: float) -> float:
+        floats = self.state.floats
+        tokens, last = floats[self.slot], floats[self.slot + 1]
+        tokens = min(self.capacity, tokens + max(now - last, 0.0) * self.rate)
+        floats[self.slot + 1] = now
+        return tokens
+
+    @property
+    def tokens(self) -> float:
+        with self.state.lock():
+            tokens = self._refill(time.monotonic())
+            self.state.floats[self.slot] = tokens
+        return tokens
+
+    def delay(self, tokens: float = 1) -> float:
+        """Take `tokens` if available, or return the seconds to wait for them."""
+        with self.state.lock():
+            available = self._refill(time.monotonic())
+            if available >= tokens:
+                available -= tokens
+                delay = 0.0
+            elif self.rate > 0:
+                delay = (tokens - available) / self.rate
+            else:
+                delay = math.inf
+            self.state.floats[self.slot] = available
+        return delay
+
+    def acquire(self, tokens: float = 1) -> bool:
+        """Take `tokens`, if available."""
+        return not self.delay(tokens)
+
+    async def wait(self, tokens: float = 1):
+        """Wait until `tokens` are taken."""
+        while delay := self.delay(tokens):
+            if math.isinf(delay):
+                raise ValueError("Tokens are never refilled", self.rate, tokens)
+            await asyncio.sleep(delay)
+
+
+class Fork(plugin.RestartPolicy):
+    """Fork `number` workers and supervise them.
+
+    A worker is respawned according to its `restart` policy, see
+    :py:obj:`plugin.RestartPolicy`. A crash looping worker is not respawned
+    anymore and is dropped from the status. After a stop signal is received,
+    the parent waits for all children to exit.
+
+    With an `affinity` every worker is pinned to its CPUs, see
+    :py:obj:`cpu_affinity`. The CPUs are assigned by the `cpu_slot` of a
+    worker, which a replacing worker takes over from the old one.
+
+    SIGHUP is not forwarded, but triggers a rolling reload: one by one, a new
+    worker is spawned and the old one is stopped by SIGINT, as soon as the new
+    one is ready. So the accept capacity of the shared sockets never drops.
+    A new worker is forked from the unchanged parent, so only what a child
+    reads itself, e.g. its config, is reloaded, but neither imported modules
+    nor preloaded plugins. With `report_ready` a new worker is ready, when it
+    sent `ready`, like :py:obj:`prepare_status` does, otherwise as soon as it
+    runs.
+
+    Every child reports its result, readiness and periodic stats through a
+    :py:obj:`Channel` to the parent, which keeps the last :py:obj:`WorkerStatus`
+    of every worker.
+    """
+
     number: int = 0
     ppid: int
     pid: int
     is_child: bool
+    worker: t.Optional[int] = None
+    # the slot, which assigns the CPUs to this worker
+    cpu_slot: t.Optional[int] = None
+    # the CPUs of this worker, if pinned
+    cpus: t.Optional[t.Set[int]] = None
 
-    def __init__(self, number: int):
+    def __init__(
+        self,
+        number: int,
+        *,
+        restart: plugin.Restart = plugin.Restart.ON_FAILURE,
+        backoff: float = 0.1,
+        max_backoff: float = 30.0,
+        max_restarts: int = 5,
+        restart_window: float = 60.0,
+        status_interval: float = 5.0,
+        reload_timeout: float = 60.0,
+        report_ready: bool = False,
+        affinity: t.Union[None, str, t.Callable[[int, t.List[int]], t.Set[int]]] = None,
+    ):
         self.number = number
+        self.report_ready = report_ready
+        self.affinity = affinity
+        self.available_cpus = sorted(os.sched_getaffinity(0))
+        self.status_interval = status_interval
+        self.reload_timeout = reload_timeout
+        self.restart = plugin.Restart(restart)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
         self.children = set()
-        self.queue = queue.Queue()
+        # pid -> worker number
+        self.workers: t.Dict[int, int] = {}
+        self.stopping = False
+        self._stop_signal = signal.SIGINT
+        self.reloading = False
+        # old pids to replace by a rolling reload
+        self._reload: t.List[int] = []
+        # new worker, old pid, ready deadline
+        self._replacing: t.Optional[t.Tuple[int, int, float]] = None
+        # pids, which are stopped on purpose
+        self._retiring: t.Set[int] = set()
+        self._next_worker = 0
+        # worker -> cpu slot
+        self.cpu_slots: t.Dict[int, int] = {}
+        # worker -> channel
+        self.channels: t.Dict[int, Channel] = {}
+        self.status: t.Dict[int, WorkerStatus] = {}
+        self.results: t.List[t.Any] = []
+        # stats of this process, which are reported to the parent
+        self.stats: t.Dict[str, t.Any] = {}
         self.pid = os.getpid()
         self.ppid = os.getppid()
         self.is_child = False
+        self._signal_handlers: t.Dict[int, t.Any] = {}
+
+    @property
+    def forks(self) -> int:
+        """The number of forked workers."""
+        return self.number or len(self.available_cpus)
 
     def run(
         self, func: t.Callable, *args: t.Any, **kv: t.Any
     ) -> t.Optional[t.List[t.Any]]:
-        forks = len(os.sched_getaffinity(0)) if not self.number else self.number
+        forks = self.forks
 
         if forks == 1:
             sl.debug("Skip forking", forks=forks, parent=os.getpid())
             return func(*args, **kv)
 
         sl.debug("Forking", forks=forks, parent=os.getpid())
-        for i in range(forks):
-            child = os.fork()
-            if child:
-                sl.debug("Child", child=child)
-                self.children.add(child)
-            else:
-                # override for child
-                self.pid = os.getpid()
-                self.ppid = os.getppid()
-                self.is_child = True
-                sl.debug("Run", child=self.pid, parent=self.ppid, func=func)
-                result = func(*args, **kv)
-                sl.debug("Stopped", child=self.pid, parent=self.ppid, func=func)
-                self.queue.put(result)
-                # stop child from iterating the rest
-                return
+        for worker in range(forks):
+            if self.spawn(worker):
+                return self._run_child(func, *args, **kv)
+        self._next_worker = forks
 
         sl.debug("Waiting for children to exit", children=self.children)
-        self.wait_for_children()
-        result = []
-        while True:
+        for worker in self.supervise():
+            if self.spawn(worker):
+                return self._run_child(func, *args, **kv)
+
+        return self.results
+
+    def spawn(self, worker: int) -> bool:
+        """Fork a child for `worker` and return `True` within the child."""
+        cpu_slot = self.cpu_slots.setdefault(worker, worker)
+        cpus = (
+            cpu_affinity(self.affinity, cpu_slot, self.available_cpus)
+            if self.affinity is not None
+            else None
+        )
+        channel = Channel()
+        child = os.fork()
+        if child:
+            sl.debug("Child", child=child, worker=worker)
+            channel.close_writer()
+            old = self.channels.pop(worker, None)
+            if old is not None:
+                old.close_reader()
+            self.channels[worker] = channel
+            self.children.add(child)
+            self.workers[child] = worker
+            self.status[worker] = WorkerStatus(pid=child, cpus=cpus)
+            if self.stopping:
+                # INFO: the stop signal may have been forwarded before
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(child, self._stop_signal)
+            return False
+
+        # override for child
+        self.pid = os.getpid()
+        self.ppid = os.getppid()
+        self.is_child = True
+        self.worker = worker
+        self.cpu_slot = cpu_slot
+        self.cpu_slots.clear()
+        self.children.clear()
+        self.workers.clear()
+        self.status.clear()
+        while self.channels:
+            _, other = self.channels.popitem()
+            other.close_reader()
+        channel.close_reader()
+        self.channels[worker] = channel
+        self._restore_signal_handlers()
+        if cpus is not None:
+            os.sched_setaffinity(0, cpus)
+            self.cpus = cpus
+            sl.info("Pinned worker", worker=worker, child=self.pid, cpus=sorted(cpus))
+        return True
+
+    def _run_child(self, func, *args, **kv):
+        sl.debug("Run", child=self.pid, parent=self.ppid, func=func)
+        result = func(*args, **kv)
+        sl.debug("Stopped", child=self.pid, parent=self.ppid, func=func)
+        try:
+            self.send("result", result)
+        except (pickle.PicklingError, TypeError, AttributeError) as ex:
+            sl.error("Result not transferable", result=result, exc_info=ex)
+        # stop child from iterating the rest
+
+    def send(self, kind: str, data: t.Any = None):
+        """Report a message to the parent.
+
+        Without a parent, the message is handled in place.
+        """
+        if self.is_child:
             try:
-                result.append(self.queue.get(False))
-            except queue.Empty:
-                break
-        return result
+                self.channels[self.worker].send(kind, data)
+            except BrokenPipeError:
+                sl.warning("Parent is gone", child=self.pid, kind=kind)
+        else:
+            self.handle(self.worker, os.getpid(), kind, data)
+
+    def handle(self, worker: t.Optional[int], pid: int, kind: str, data: t.Any):
+        """Handle a message reported by a worker."""
+        status = self.status.get(worker)
+        if status is None or status.pid != pid:
+            status = self.status[worker] = WorkerStatus(pid=pid)
+        status.updated = time.time()
+        if kind == "ready":
+            status.ready = True
+            sl.info("Worker ready", worker=worker, pid=pid)
+        elif kind == "stats":
+            status.stats = data
+        elif kind == "result":
+            self.results.append(data)
+        else:
+            sl.warning("Unknown worker message", worker=worker, kind=kind)
+
+    def aggregate(self) -> t.Dict[str, t.Any]:
+        """Aggregate the status of all workers, numeric stats are summed."""
+        stats: t.Dict[str, t.Any] = {
+            "workers": len(self.status),
+            "ready": sum(status.ready for status in self.status.values()),
+        }
+        for status in self.status.values():
+            for key, value in status.stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def _receive(self, worker: int) -> bool:
+        channel = self.channels[worker]
+        messages = channel.receive()
+        if messages is None:
+            channel.close_reader()
+            return False
+        pid = self.status[worker].pid
+        for kind, data in messages:
+            self.handle(worker, pid, kind, data)
+        return True
+
+    async def report_status(self, lifecycle: plugin.Lifecycle):
+        """Report readiness and then periodically the stats to the parent,
+        until the stage is draining.
+
+        The stats contain the resident set size and the lag of the event loop
+        besides the stats of this process.
+        """
+        await lifecycle.wait(plugin.State.READY)
+        self.send("ready")
+        loop = asyncio.get_running_loop()
+        lag = 0.0
+        while lifecycle.state < plugin.State.DRAINING:
+            self.send("stats", {**self.stats, "rss": _rss(), "loop_lag": lag})
+            start = loop.time()
+            try:
+                await asyncio.wait_for(
+                    lifecycle.wait(plugin.State.DRAINING), self.status_interval
+                )
+            except TimeoutError:
+                lag = max(loop.time() - start - self.status_interval, 0.0)
 
     def _signal_children(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+            return
+        if signum in STOP_SIGNALS:
+            self.stopping = True
+            self._stop_signal = signum
         for child in self.children:
-            os.kill(child, signum)
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(child, signum)
 
-    def wait_for_children(self):
+    def _install_signal_handlers(self):
         # forward signal to children
-        for signum in (
-            signal.SIGINT,
-            signal.SIGTERM,
-            signal.SIGHUP,
-            signal.SIGQUIT,
-            signal.SIGABRT,
-            signal.SIGWINCH,
-            signal.SIGUSR1,
-            signal.SIGUSR2,
-        ):
-            signal.signal(signum, self._signal_children)
-        # just wait for them
+        for signum in FORWARD_SIGNALS:
+            self._signal_handlers[signum] = signal.signal(signum, self._signal_children)
+
+    def _restore_signal_handlers(self):
+        while self._signal_handlers:
+            signum, handler = self._signal_handlers.popitem()
+            signal.signal(signum, handler)
+
+    def should_restart(self, failed: bool) -> bool:
+        return not self.stopping and super().should_restart(failed)
+
+    def _drop(self, worker: int):
+        """Forget a worker slot, which is not respawned anymore."""
+        self.status.pop(worker, None)
+        self.cpu_slots.pop(worker, None)
+        channel = self.channels.pop(worker, None)
+        if channel is not None:
+            channel.close_reader()
+
+    def _wait(self, pgid: int, timeout: t.Optional[float]):
+        """Receive messages of the children until one of them exits or
+        `timeout`."""
+        readers = {
+            channel.reader: worker
+            for worker, channel in self.channels.items()
+            if channel.reader is not None
+        }
+        if not readers:
+            if timeout is None:
+                return os.waitid(os.P_PGID, pgid, os.WEXITED)
+            info = os.waitid(os.P_PGID, pgid, os.WEXITED | os.WNOHANG)
+            if info is None:
+                time.sleep(min(max(timeout, 0), 0.05))
+            return info
+
+        # INFO: a child closes its channel at exit, so we are woken up
+        ready, _, _ = select.select(
+            list(readers), [], [], 1.0 if timeout is None else max(timeout, 0)
+        )
+        eof = False
+        for reader in ready:
+            eof |= not self._receive(readers[reader])
+        # INFO: a closed channel means that its child is exiting
+        return os.waitid(
+            os.P_PGID, pgid, os.WEXITED if eof else os.WEXITED | os.WNOHANG
+        )
+
+    def _stop(self, child: int):
+        sl.info("Stopping worker", child=child)
+        self._retiring.add(child)
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(child, signal.SIGINT)
+
+    def _roll(self, now: float) -> t.Optional[int]:
+        """Advance a rolling reload and return a new worker to spawn."""
+        if self.stopping:
+            self.reloading = False
+            self._reload.clear()
+            self._replacing = None
+            return None
+
+        if self.reloading:
+            self.reloading = False
+            if self._reload or self._replacing:
+                sl.warning("Rolling reload already in progress")
+            else:
+                self._reload = sorted(self.workers)
+                sl.info("Rolling reload", children=self._reload)
+
+        if self._replacing is not None:
+            worker, old, deadline = self._replacing
+            if worker not in self.workers.values():
+                sl.error("Rolling reload aborted, new worker exited", worker=worker)
+                self._reload.clear()
+                self._replacing = None
+            elif old in self.workers:
+                if self.status[worker].ready or not self.report_ready:
+                    if old not in self._retiring:
+                        self._stop(old)
+                elif now > deadline:
+                    sl.error(
+                        "Rolling reload aborted, new worker not ready", worker=worker
+                    )
+                    self._reload.clear()
+                    self._replacing = None
+                    self._stop(
+                        next(pid for pid, w in self.workers.items() if w == worker)
+                    )
+            else:
+                # old worker is gone
+                self._replacing = None
+            if self._replacing is not None:
+                return None
+
+        while self._reload:
+            old = self._reload.pop(0)
+            if old in self.workers:
+                worker = self._next_worker
+                self._next_worker += 1
+                # INFO: the new worker runs on the CPUs of the old one
+                self.cpu_slots[worker] = self.cpu_slots.get(
+                    self.workers[old], self.workers[old]
+                )
+                self._replacing = (worker, old, now + self.reload_timeout)
+                sl.info("Replacing worker", child=old, worker=worker)
+                return worker
+        return None
+
+    def supervise(self) -> t.Iterator[int]:
+        """Wait for all children to exit and yield the workers to respawn."""
+        self._install_signal_handlers()
         pgid = os.getpgid(self.pid)
-        os.waitid(os.P_PGID, pgid, os.WEXITED)
+        restart_times: t.Dict[int, t.List[float]] = {}
+        # worker -> due time
+        pending: t.Dict[int, float] = {}
+        try:
+            while self.workers or pending:
+                if self.stopping:
+                    pending.clear()
+                now = time.monotonic()
+                for worker, due in sorted(pending.items(), key=lambda x: x[1]):
+                    if due <= now:
+                        del pending[worker]
+                        yield worker
+                # INFO: a new worker may already be ready after its spawn
+                while (worker := self._roll(now)) is not None:
+                    yield worker
+                if not self.workers and not pending:
+                    break
+
+                try:
+                    info = self._wait(
+                        pgid, min(pending.values()) - now if pending else None
+                    )
+                except ChildProcessError:
+                    sl.error("Lost all children", children=self.children)
+                    self.children.clear()
+                    self.workers.clear()
+                    continue
+                if info is None:
+                    continue
+
+                child = info.si_pid
+                worker = self.workers.pop(child, None)
+                self.children.discard(child)
+                if worker is None:
+                    continue
+                # receive the last messages
+                channel = self.channels[worker]
+                while channel.reader is not None and self._receive(worker):
+                    ...
+                status = self.status[worker]
+                # INFO: a new worker, which exits before it is ready, aborts a
+                # rolling reload in _roll; an old worker, which exits while it
+                # is replaced, leaves its place to the new one
+                if (
+                    child in self._retiring
+                    or (
+                        self._replacing is not None
+                        and self._replacing[0] == worker
+                        and not status.ready
+                    )
+                    or (self._replacing is not None and self._replacing[1] == child)
+                ):
+                    # the worker slot is retired
+                    self._retiring.discard(child)
+                    self._drop(worker)
+                    sl.info("Worker retired", child=child, worker=worker)
+                    continue
+                status.ready = False
+
+                if info.si_code == os.CLD_EXITED:
+                    failed = info.si_status != 0
+                    sl.info(
+                        "Child exited",
+                        child=child,
+                        worker=worker,
+                        exit_code=info.si_status,
+                    )
+                else:
+                    failed = True
+                    sl.warning(
+                        "Child killed",
+                        child=child,
+                        worker=worker,
+                        signal=_signal_name(info.si_status),
+                    )
+
+                if not self.should_restart(failed):
+                    continue
+
+                now = time.monotonic()
+                delay = self.restart_delay(
+                    failed, now, restart_times.setdefault(worker, [])
+                )
+                if delay is None:
+                    sl.error("Worker is crash looping", worker=worker)
+                    self._drop(worker)
+                    continue
+                sl.warning("Respawning worker", worker=worker, delay=delay)
+                pending[worker] = now + delay
+        finally:
+            if not self.is_child:
+                self._restore_signal_handlers()
+                while self.channels:
+                    _, channel = self.channels.popitem()
+                    channel.close_reader()
+
+
+async def prepare_status(
+    fork: Fork, lifecycle: plugin.Lifecycle, teardown: plugin.Teardown
+):
+    """Report the status of a forked child to its parent.
+
+    The reporter runs beside the stage tasks, so that it neither keeps the
+    stage running nor adds to its results.
+    """
+    if not fork.is_child:
+        return
+    reporter = asyncio.create_task(fork.report_status(lifecycle))
+
+    async def stop_reporter():
+        reporter.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await reporter
+
+    teardown.add(stop_reporter(), name="report_status")
+
+
+PreloadSignals = plugin.PreloadSignals
+
+
+class Preload(plugin.Preload):
+    """Load plugins once in the parent process before forking.
+
+    All children share the imported modules, registered adapters and
+    components of the preloaded plugins copy-on-write and only load the
+    remaining plugins and create their tasks.
+
+    Preloaded plugins must not yield tasks, since their event loop is not
+    usable in a forked child. Their teardown runs in the parent, after all
+    children exited.
+    """
+
+    def freeze(self):
+        """Move all objects into the permanent generation, so that the garbage
+        collector of a child does not touch and hence copy their pages."""
+        gc.collect()
+        gc.freeze()
+        sl.debug("Froze preloaded objects", count=gc.get_freeze_count())
+
+
+def _stage_worker(f: Fork, sockets: Sockets, *plugins, components, **kwargs):
+    if f.is_child:
+        for name, sock in sockets.for_worker(f.cpu_slot).items():
+            components.add(sock, name=name)
+    return plugin.stage(*plugins, components=components, **kwargs)
 
 
 def stage(
@@ -179,15 +1325,67 @@ def stage(
     loop=None,
     forks: int = 0,
     sockets: t.Optional[t.Sequence[str]] = None,
+    loop_factory: t.Optional[t.Callable[[], asyncio.AbstractEventLoop]] = None,
+    preload: t.Sequence = (),
+    affinity: t.Union[None, str, t.Callable[[int, t.List[int]], t.Set[int]]] = None,
+    shared_slots: int = 1024,
+    discover: bool = False,
 ):
+    """Fork and run a stage of `plugins` in every child.
+
+    :param preload: plugins to load in the parent, see :py:obj:`Preload`
+    :param discover: load the plugins of the entry point group, which are
+        discovered once in the parent, see :py:obj:`plugin.discover_plugins`
+    :param affinity: pin the workers to CPUs, see :py:obj:`cpu_affinity`
+    :param shared_slots: the size of the :py:obj:`SharedState`, which is
+        added, if `components` has none
+    """
     if components is None:
         components = Components()
+    if discover:
+        plugins = (*plugin.discover_plugins().values(), *plugins)
+
+    shared = None
+    if components.get(SharedState, default=None) is None:
+        shared = components.add(SharedState(shared_slots))
 
-    f = components.add(Fork(forks))
-    with Sockets(*sockets).bind() as s:
+    # INFO: every child gets a fresh loop, since a forked loop is not usable
+    if loop is None and loop_factory is None:
+        loop_factory = configured_loop_factory(components)
+
+    f = components.add(Fork(forks, report_ready=True, affinity=affinity))
+    with Sockets(*(sockets or ())).bind() as s:
         # register sockets
-        for name, s in s.items():
-            components.add(s, name=name)
+        for name, sock in s.items():
+            components.add(sock, name=name)
 
-        result = f.run(plugin.stage, *plugins, components=components, loop=loop)
+        pre = None
+        loaded = ()
+        if preload:
+            pre = Preload(
+                *preload,
+                components=components,
+                loop=loop,
+                loop_factory=loop_factory,
+            )
+            components, loaded = pre.components, pre.loaded
+            pre.freeze()
+        try:
+            result = f.run(
+                _stage_worker,
+                f,
+                s,
+                *plugins,
+                prepare_status,
+                components=components,
+                loop=loop,
+                loop_factory=loop_factory,
+                loaded=loaded,
+            )
+        finally:
+            if pre is not None and not f.is_child:
+                gc.unfreeze()
+                pre.close()
+            if shared is not None and not f.is_child:
+                shared.close()
         return result
@@ -1,15 +1,21 @@
+import asyncio
+import atexit
 import dataclasses as dc
 import functools
 import logging
 import logging.config
+import logging.handlers
+import os
+import queue
 import sys
 import typing
+import weakref
 from os import getpid
 
 import structlog
 from structlog.processors import JSONRenderer
 
-from . import util
+from . import context, plugin, util
 
 
 def stringify_dict_keys(obj):
@@ -54,6 +60,66 @@ LOGGING_LEVEL_NAMES = list(
 )
 DEFAULT_LOGGING_LEVEL = logging.getLevelName(logging.WARNING)
 timestamper = structlog.processors.TimeStamper(fmt="ISO", utc=True)
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-new")
+
+
+class OverflowQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records into a bounded queue.
+
+    If the queue is full, the record is enqueued after the listener made
+    room (`block`), the oldest record is dropped (`drop-oldest`) or the
+    record itself is dropped (`drop-new`). Dropped records are counted.
+    """
+
+    def __init__(self, queue_: queue.Queue, overflow: str = "block"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}", overflow)
+        super().__init__(queue_)
+        self.overflow = overflow
+        self.dropped = 0
+
+    def prepare(self, record):
+        # INFO: the record is formatted by the listener thread, so that the
+        # event loop does not render it
+        if not isinstance(record.msg, dict) and record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                self.dropped += 1
+                if self.overflow == "drop-new":
+                    return
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+
+# the log config with the active queue, which is restarted in a forked child
+_queue_config: typing.Optional["weakref.ref[LogConfig]"] = None
+_at_fork_registered = False
+
+
+def _restart_queue_in_child():
+    # INFO: a forked child has no listener thread to drain the queue
+    log_config = _queue_config() if _queue_config is not None else None
+    if log_config is not None:
+        log_config.restart_queue()
+
+
+class QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # INFO: wait for room in a full queue
+        self.queue.put(self._sentinel)
 
 
 @dc.dataclass
@@ -66,6 +132,26 @@ class LogConfig:
     json_renderer: JSONRenderer = JSONRenderer(
         serializer=lambda obj, **kwargs: json_dumps(stringify_dict_keys(obj), **kwargs)
     )
+    # write records by a thread, if the queue size is not 0
+    queue_size: int = 0
+    overflow: str = "block"
+
+    def __post_init__(self):
+        # INFO: runtime handles are no fields, so they are no config options
+        self._queue_handler: typing.Optional[OverflowQueueHandler] = None
+        self._listener: typing.Optional[QueueListener] = None
+
+    @property
+    def queue_handler(self) -> typing.Optional[OverflowQueueHandler]:
+        return self._queue_handler
+
+    @property
+    def listener(self) -> typing.Optional[QueueListener]:
+        return self._listener
+
+    @property
+    def dropped(self) -> int:
+        return self._queue_handler.dropped if self._queue_handler is not None else 0
 
     @property
     def processors(self):
@@ -106,6 +192,7 @@ class LogConfig:
         return pre_chain
 
     def setup(self):
+        self.stop()
         level = (
             logging.getLevelName(self.level.upper())
             if isinstance(self.level, str)
@@ -133,6 +220,8 @@ class LogConfig:
         if self.user_config:
             util.merge_dict(self.user_config, dest=config)
         logging.config.dictConfig(config)
+        if self.queue_size:
+            self.start_queue()
 
         logging.captureWarnings(self.capture_warnings)
 
@@ -153,10 +242,78 @@ class LogConfig:
         # log uncaught exceptions
         sys.excepthook = uncaught_exception
 
+    def start_queue(self):
+        """Move the root handlers behind a bounded queue."""
+        global _queue_config, _at_fork_registered
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        self._queue_handler = OverflowQueueHandler(
+            queue.Queue(self.queue_size), self.overflow
+        )
+        self._listener = QueueListener(
+            self._queue_handler.queue, *handlers, respect_handler_level=True
+        )
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(self._queue_handler)
+        self._listener.start()
+        atexit.register(self.stop)
+
+        _queue_config = weakref.ref(self)
+        if not _at_fork_registered:
+            # INFO: a hook cannot be unregistered
+            os.register_at_fork(after_in_child=_restart_queue_in_child)
+            _at_fork_registered = True
+
+    def restart_queue(self):
+        """Replace the queue and its listener thread in a forked child."""
+        if self._listener is None:
+            return
+        self._queue_handler.queue = queue.Queue(self.queue_size)
+        self._queue_handler.dropped = 0
+        self._listener = QueueListener(
+            self._queue_handler.queue,
+            *self._listener.handlers,
+            respect_handler_level=True,
+        )
+        self._listener.start()
+
+    def stop(self):
+        """Restore the root handlers and write all queued records."""
+        if self._listener is None:
+            return
+        global _queue_config
+        listener, self._listener = self._listener, None
+        atexit.unregister(self.stop)
+        if _queue_config is not None and _queue_config() is self:
+            _queue_config = None
+        root = logging.getLogger()
+        root.removeHandler(self._queue_handler)
+        for handler in listener.handlers:
+            root.addHandler(handler)
+        listener.stop()
+        if self.dropped:
+            structlog.get_logger().warning(
+                "Dropped log records", dropped=self.dropped, overflow=self.overflow
+            )
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.stop)
+
 
 def setup_logging(**kwargs):
     log_config = LogConfig(**kwargs)
     log_config.setup()
+    return log_config
+
+
+async def prepare(teardown: plugin.Teardown):
+    """Flush the queued records of a :py:obj:`LogConfig` component, after all
+    other teardown tasks."""
+    log_config = context.get(LogConfig, default=None)
+    if log_config is not None and log_config.listener is not None:
+        teardown.add(log_config.flush(), phase=sys.maxsize, name="log")
 
 
 class ExtractLogExtra:  # noqa: R0903
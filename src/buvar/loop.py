@@ -0,0 +1,105 @@
+"""Create event loops for stages.
+
+The loop implementation is selected by :py:obj:`LoopConfig`, which is loaded
+from the `loop` section of a :py:obj:`buvar.config.ConfigSource`. The
+`BUVAR_LOOP_*` environment vars, e.g. `BUVAR_LOOP_POLICY=uvloop`, override it
+regardless of the env prefix of the source.
+
+    >>> LoopConfig(policy="asyncio").factory is asyncio.new_event_loop
+    True
+    >>> LoopConfig(policy="foo").factory
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Unknown loop policy: foo', 'foo')
+"""
+
+import asyncio
+import dataclasses as dc
+import typing as t
+
+import structlog
+
+from . import components, config, context, util
+
+LOOP_CONFIG_SECTION = "loop"
+LOOP_ENV_PREFIX = "BUVAR"
+
+sl = structlog.get_logger()
+
+LoopFactory = t.Callable[[], asyncio.AbstractEventLoop]
+
+
+def _uvloop_factory() -> LoopFactory:
+    import uvloop
+
+    return uvloop.new_event_loop
+
+
+def _auto_factory() -> LoopFactory:
+    try:
+        return _uvloop_factory()
+    except ImportError:
+        return asyncio.new_event_loop
+
+
+LOOP_POLICIES: t.Dict[str, t.Callable[[], LoopFactory]] = {
+    "auto": _auto_factory,
+    "asyncio": lambda: asyncio.new_event_loop,
+    "uvloop": _uvloop_factory,
+}
+
+
+@dc.dataclass
+class LoopConfig:
+    """Select the event loop implementation.
+
+    :param policy: `auto` prefers uvloop if installed, `asyncio`, `uvloop` or a
+        dotted name of a loop factory
+    :param debug: enable asyncio debug mode
+    :param stacking_tasks: install :py:obj:`buvar.context.StackingTaskFactory`
+    """
+
+    policy: str = "auto"
+    debug: bool = False
+    stacking_tasks: bool = True
+
+    @property
+    def factory(self) -> LoopFactory:
+        try:
+            return LOOP_POLICIES[self.policy]()
+        except KeyError:
+            if ":" not in self.policy:
+                raise ValueError(f"Unknown loop policy: {self.policy}", self.policy)
+            return util.resolve_dotted_name(self.policy)
+
+    def new_event_loop(self) -> asyncio.AbstractEventLoop:
+        loop = self.factory()
+        loop.set_debug(self.debug)
+        if self.stacking_tasks:
+            context.StackingTaskFactory.set(loop=loop)
+        sl.debug("New event loop", policy=self.policy, loop=loop)
+        return loop
+
+
+def load_loop_config(cmps: t.Optional[components.Components] = None) -> LoopConfig:
+    """Load the loop config from a config source component.
+
+    The `BUVAR_LOOP_*` environment vars are applied on top of the config source
+    and its own env overrides.
+    """
+    source = cmps.get(config.ConfigSource, default=None) if cmps is not None else None
+    values = (
+        dc.asdict(source.load(LoopConfig, LOOP_CONFIG_SECTION))
+        if source is not None
+        else {}
+    )
+    return config.ConfigSource(
+        {LOOP_CONFIG_SECTION: values}, env_prefix=LOOP_ENV_PREFIX
+    ).load(LoopConfig, LOOP_CONFIG_SECTION)
+
+
+def configured_loop_factory(
+    cmps: t.Optional[components.Components] = None,
+) -> LoopFactory:
+    """Return a loop factory configured by `cmps`."""
+    return load_loop_config(cmps).new_event_loop
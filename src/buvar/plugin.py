@@ -6,7 +6,6 @@ These tasks are then run until complete.
 A py:obj:`buvar.components.Components` context is stacked in way, that plugins
 share the same context, while tasks don't, but may access the plugin context.
 
-    >>> loop = asyncio.get_event_loop()
     >>> state = {}
     >>> async def prepare(load: Loader):
     ...     async def some_task():
@@ -29,18 +28,31 @@ share the same context, while tasks don't, but may access the plugin context.
 # XXX FIXME doctest sometime shows log messages
 import asyncio
 import collections.abc
+import contextlib
+import contextvars
+import enum
+import functools
+import importlib.metadata
 import inspect
 import itertools
+import json
+import os
 import signal
 import sys
+import threading
 import types
 import typing as t
+import weakref
 
 import structlog
 
-from . import context, util
+from . import components, context, di, util
+from .components import Components
+from .loop import configured_loop_factory
 
 PLUGIN_FUNCTION_NAME = "prepare"
+PLUGIN_ENTRY_POINT_GROUP = "buvar.plugins"
+PLUGIN_INDEX_ENV = "BUVAR_PLUGIN_INDEX"
 
 
 sl = structlog.get_logger()
@@ -50,32 +62,331 @@ class Cancel(asyncio.Event):
     pass
 
 
-class Teardown:
-    """A collection of teardown tasks."""
+class State(enum.IntEnum):
+    """The lifecycle states of a stage in their order."""
+
+    STARTING = 0
+    READY = 1
+    DRAINING = 2
+    STOPPING = 3
+
+
+class Lifecycle:
+    """Track the state of a stage and its in-flight work.
+
+    After `Cancel` is set, the stage is draining: no new work should be
+    accepted, while in-flight work is finished. Tasks are cancelled, when
+    the stage is stopping.
+
+    >>> async def handle(lifecycle: Lifecycle):
+    ...     if not lifecycle.accepting:
+    ...         return
+    ...     with lifecycle.in_flight():
+    ...         ...
+    """
 
     def __init__(self):
-        self.tasks = []
+        self.state = State.STARTING
+        self.in_flight_count = 0
+        self._states = {state: asyncio.Event() for state in State}
+        self._states[State.STARTING].set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} {self.state.name}"
+            f" in_flight={self.in_flight_count}>"
+        )
 
-    def add(self, task):
-        self.tasks.append(task)
+    @property
+    def accepting(self) -> bool:
+        return self.state < State.DRAINING
+
+    def set(self, state: State):
+        """Advance to `state`; a lifecycle never goes back."""
+        if state <= self.state:
+            return
+        sl.debug("Stage state", state=state.name, in_flight=self.in_flight_count)
+        self.state = state
+        for reached in State:
+            if reached <= state:
+                self._states[reached].set()
+
+    async def wait(self, state: State):
+        """Wait until `state` is reached."""
+        await self._states[state].wait()
+
+    @contextlib.contextmanager
+    def in_flight(self):
+        """Count the enclosed work as in-flight."""
+        self.in_flight_count += 1
+        self._idle.clear()
+        try:
+            yield self
+        finally:
+            self.in_flight_count -= 1
+            if not self.in_flight_count:
+                self._idle.set()
+
+    async def drained(self):
+        """Wait until there is no more in-flight work."""
+        await self._idle.wait()
+
+
+class TeardownEntry:
+    """A teardown awaitable and the report of its execution."""
+
+    __slots__ = (
+        "awaitable",
+        "phase",
+        "timeout",
+        "name",
+        "duration",
+        "timed_out",
+        "error",
+    )
+
+    def __init__(
+        self,
+        awaitable: t.Awaitable,
+        *,
+        phase: int = 0,
+        timeout: t.Optional[float] = None,
+        name: t.Optional[str] = None,
+    ):
+        self.awaitable = awaitable
+        self.phase = phase
+        self.timeout = timeout
+        self.name = name or getattr(awaitable, "__qualname__", None) or repr(awaitable)
+        self.duration: t.Optional[float] = None
+        self.timed_out = False
+        self.error: t.Optional[BaseException] = None
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} {self.name} phase={self.phase}"
+            f" duration={self.duration} timed_out={self.timed_out}>"
+        )
+
+    async def run(self, timeout: t.Optional[float] = None):
+        timeout = self.timeout if self.timeout is not None else timeout
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            await asyncio.wait_for(self.awaitable, timeout)
+        except TimeoutError:
+            self.timed_out = True
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.duration = loop.time() - start
+        return self
+
+
+class Teardown:
+    """A collection of teardown tasks.
+
+    Tasks are grouped into phases, which run in ascending order, while all
+    tasks of a phase run concurrently. A task exceeding its deadline is
+    cancelled.
+    """
+
+    def __init__(self, *, timeout: t.Optional[float] = None, slow: float = 1.0):
+        self.timeout = timeout
+        self.slow = slow
+        self.entries: t.List[TeardownEntry] = []
+
+    @property
+    def tasks(self):
+        return [entry.awaitable for entry in self.entries]
+
+    def add(
+        self,
+        task,
+        *,
+        phase: int = 0,
+        timeout: t.Optional[float] = None,
+        name: t.Optional[str] = None,
+    ):
+        """Add a teardown awaitable.
+
+        :param phase: lower phases are torn down first
+        :param timeout: the deadline of this task, which defaults to the
+            teardown timeout
+        """
+        self.entries.append(
+            TeardownEntry(task, phase=phase, timeout=timeout, name=name)
+        )
 
     def __iter__(self):
         return reversed(self.tasks)
 
-    async def wait(self):
-        await asyncio.gather(*self)
+    def phases(self) -> t.List[t.List[TeardownEntry]]:
+        phases: t.Dict[int, t.List[TeardownEntry]] = {}
+        for entry in self.entries:
+            phases.setdefault(entry.phase, []).append(entry)
+        return [phases[phase] for phase in sorted(phases)]
+
+    async def wait(self) -> t.List[TeardownEntry]:
+        """Run all phases and return a report of every teardown task."""
+        report = []
+        for entries in self.phases():
+            report.extend(
+                await asyncio.gather(*(entry.run(self.timeout) for entry in entries))
+            )
+        for entry in report:
+            if entry.timed_out:
+                sl.warning("Teardown timed out", teardown=entry)
+            elif entry.error is not None:
+                sl.error("Teardown failed", teardown=entry, exc_info=entry.error)
+            elif entry.duration >= self.slow:
+                sl.warning("Teardown is slow", teardown=entry)
+        return report
+
+
+class Restart(enum.Enum):
+    """Restart policy of a supervised task."""
+
+    NEVER = "never"
+    ON_FAILURE = "on-failure"
+    ALWAYS = "always"
+
+
+class RestartPolicy:
+    """Decide whether and when to restart after a run.
+
+    Only failed runs are delayed by an exponential backoff and count towards a
+    crash loop, which is detected, if there are more than `max_restarts`
+    restarts within `restart_window` seconds. A successful run is restarted
+    after `backoff`.
+    """
+
+    restart: Restart
+    backoff: float
+    max_backoff: float
+    max_restarts: int
+    restart_window: float
+
+    def should_restart(self, failed: bool) -> bool:
+        if self.restart is Restart.ALWAYS:
+            return True
+        return failed and self.restart is Restart.ON_FAILURE
+
+    def restart_delay(
+        self, failed: bool, now: float, restart_times: t.List[float]
+    ) -> t.Optional[float]:
+        """Return the delay of the restart or `None` for a crash loop.
+
+        :param restart_times: the restarts after failures, which are updated
+            in place
+        """
+        if not failed:
+            return self.backoff
+        restart_times[:] = [
+            ts for ts in restart_times if now - ts < self.restart_window
+        ]
+        if len(restart_times) >= self.max_restarts:
+            return None
+        restart_times.append(now)
+        return min(self.backoff * 2 ** (len(restart_times) - 1), self.max_backoff)
+
+
+class Supervised(RestartPolicy):
+    """A task, which is restarted according to its policy.
+
+    Since an awaitable can only be awaited once, the supervised task is created
+    by `factory` for every run. A crash loop is detected, if there are more
+    than `max_restarts` restarts after a failure within `restart_window`
+    seconds; the last result resp. exception is returned then. A successful
+    run is restarted after `backoff`.
+
+    If a critical task finishes for good, the stage is cancelled.
+
+    >>> async def consume():
+    ...     ...
+    >>> async def prepare():
+    ...     yield Supervised(consume, restart=Restart.ON_FAILURE)
+    """
+
+    def __init__(
+        self,
+        factory: t.Callable[[], t.Awaitable],
+        *,
+        restart: Restart = Restart.ON_FAILURE,
+        critical: bool = False,
+        backoff: float = 0.1,
+        max_backoff: float = 30.0,
+        max_restarts: int = 5,
+        restart_window: float = 60.0,
+    ):
+        self.factory = factory
+        self.restart = Restart(restart)
+        self.critical = critical
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.restarts = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} {self.factory!r}"
+            f" restart={self.restart.value} restarts={self.restarts}>"
+        )
+
+    async def supervise(self, evt_cancel: asyncio.Event):
+        restart_times: t.List[float] = []
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                result = await self.factory()
+                failed = False
+            except Exception as ex:
+                result = ex
+                failed = True
+
+            if evt_cancel.is_set() or not self.should_restart(failed):
+                break
+
+            delay = self.restart_delay(failed, loop.time(), restart_times)
+            if delay is None:
+                sl.error("Task is crash looping", task=self, result=result)
+                break
+            if failed:
+                sl.warning("Restarting task", task=self, result=result, delay=delay)
+            else:
+                sl.debug("Restarting task", task=self, result=result, delay=delay)
+            try:
+                await asyncio.wait_for(evt_cancel.wait(), delay)
+                break
+            except TimeoutError:
+                pass
+            self.restarts += 1
+
+        if failed:
+            raise result
+        return result
 
 
 class Loader:
-    """Load plugins and collect tasks."""
+    """Load plugins and collect tasks.
 
-    def __init__(self):
-        self._tasks = {}
+    :param loaded: plugins, which are already loaded elsewhere, e.g. in a
+        parent process, and are skipped
+    """
+
+    def __init__(self, loaded: t.Iterable[t.Callable] = ()):
+        self._tasks = {plugin: [] for plugin in loaded}
 
     @property
     def tasks(self):
         return iter(itertools.chain(*self._tasks.values()))
 
+    @property
+    def plugins(self) -> t.Tuple[t.Callable, ...]:
+        return tuple(self._tasks)
+
     async def __call__(self, *plugins):
         """Hook the plugin from another plugin.
 
@@ -95,12 +406,18 @@ class Loader:
                 # mark plugin as loaded for recursive circular stuff
                 self._tasks[plugin] = []
                 # load plugin
-                args = collect_plugin_args(plugin)
+                info = plugin_info(plugin)
+                args = await resolve_plugin_args(info)
                 try:
                     result = plugin(**args)
                 except TypeError as ex:
                     raise TypeError(*ex.args, plugin.__module__, plugin.__name__)
-                callables = [fun async for fun in generate_async_result(result)]
+                callables = [
+                    fun
+                    async for fun in (
+                        result if info.is_async_gen else generate_async_result(result)
+                    )
+                ]
                 self._tasks[plugin].extend(callables)
 
 
@@ -154,6 +471,12 @@ class Signals:
     #     ...
 
 
+class ThreadSignals(Signals):
+    """Signals are only handled by the main thread, see :py:obj:`Threads`."""
+
+    handlers = ()
+
+
 class Stage:
     """Stage manages the context stack while running each phase of the machinery.
 
@@ -166,6 +489,14 @@ class Stage:
     3. stage management context, e.g. Cancel, Teardown, Loader
 
     4. the shared plugin preparation context
+
+    Without a `loop`, the stage creates and owns a fresh loop by `loop_factory`,
+    which is configured by :py:obj:`buvar.loop.LoopConfig` by default. An owned
+    loop is closed after :py:obj:`run` or when a stage used as a context manager
+    exits.
+
+    With `discover`, the plugins of the :py:obj:`PLUGIN_ENTRY_POINT_GROUP` are
+    loaded before the passed ones, see :py:obj:`discover_plugins`.
     """
 
     def __init__(
@@ -174,9 +505,20 @@ class Stage:
         loop=None,
         signals: t.Type[Signals] | None = None,
         cancel_timeout: float = 60.0,
+        teardown_timeout: t.Optional[float] = None,
+        loop_factory: t.Optional[t.Callable[[], asyncio.AbstractEventLoop]] = None,
+        loaded: t.Iterable[t.Callable] = (),
+        discover: bool = False,
     ):
         self.cancel_timeout = cancel_timeout
-        self.loop = loop or asyncio.get_event_loop()
+        self.discover = discover
+        self.owns_loop = False
+        if loop is None:
+            # INFO: the loop is not installed as the current loop of the thread,
+            # so that the loop of the caller is kept
+            loop = (loop_factory or configured_loop_factory(components))()
+            self.owns_loop = True
+        self.loop = loop
         self.context = (
             context.current_context()
             .push(*(components.stack if components else ()))
@@ -184,40 +526,60 @@ class Stage:
         )
         # provide basic components
         self.cancel = self.context.add(Cancel())
-        self.teardown = self.context.add(Teardown())
-        self.loader = self.context.add(Loader())
+        self.lifecycle = self.context.add(Lifecycle())
+        self.teardown = self.context.add(Teardown(timeout=teardown_timeout))
+        self.loader = self.context.add(Loader(loaded))
         self.signals = self.context.add((signals or Signals)(self))
 
         self.context = self.context.push()
 
-    def load(self, *plugins):
-        sl.info("Loading plugins")
+    def run_until_complete(self, coro):
+        """Run `coro` directly in the stage context.
+
+        The context is passed explicitly to the task, so that a
+        :py:obj:`buvar.context.StackingTaskFactory` does not stack it.
+        """
 
         @context.run(self.context)
-        def _load():
-            self.loop.run_until_complete(self.loader(*plugins))
+        def _run():
+            return self.loop.run_until_complete(
+                self.loop.create_task(coro, context=contextvars.copy_context())
+            )
 
-        _load()
+        return _run()
+
+    def load(self, *plugins):
+        sl.info("Loading plugins")
+        if self.discover:
+            plugins = (*discover_plugins().values(), *plugins)
+        self.run_until_complete(self.loader(*plugins))
 
     def run_tasks(self):
         sl.info("Running tasks", tasks=self.loader.tasks)
-
-        @context.run(self.context)
-        def _run_tasks():
-            return self.loop.run_until_complete(
-                run(
-                    tasks=self.loader.tasks,
-                    evt_cancel=self.cancel,
-                    cancel_timeout=self.cancel_timeout,
-                )
+        return self.run_until_complete(
+            run(
+                tasks=self.loader.tasks,
+                evt_cancel=self.cancel,
+                cancel_timeout=self.cancel_timeout,
+                lifecycle=self.lifecycle,
             )
-
-        return _run_tasks()
+        )
 
     def run_teardown(self):
         sl.info("Teardown", tasks=self.teardown.tasks)
         self.loop.run_until_complete(self.teardown.wait())
 
+    def close(self):
+        """Close the loop, if the stage owns it."""
+        if self.owns_loop and not self.loop.is_closed():
+            self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def run(self, *plugins):
         """Start the asyncio process by bootstrapping the root plugins.
 
@@ -238,8 +600,11 @@ class Stage:
             # stage 2: run main task and collect teardown tasks
             return self.run_tasks()
         finally:
-            # stage 3: teardown
-            self.run_teardown()
+            try:
+                # stage 3: teardown
+                self.run_teardown()
+            finally:
+                self.close()
 
 
 def stage(
@@ -248,51 +613,251 @@ def stage(
     loop=None,
     signals: t.Type[Signals] | None = None,
     cancel_timeout: float = 60.0,
+    teardown_timeout: t.Optional[float] = None,
+    loop_factory: t.Optional[t.Callable[[], asyncio.AbstractEventLoop]] = None,
+    loaded: t.Iterable[t.Callable] = (),
+    discover: bool = False,
 ):
-    if loop is None:
-        loop = asyncio.get_event_loop()
+    with Stage(
+        components=components,
+        loop=loop,
+        signals=signals,
+        cancel_timeout=cancel_timeout,
+        teardown_timeout=teardown_timeout,
+        loop_factory=loop_factory,
+        loaded=loaded,
+        discover=discover,
+    ) as stage:
+        return stage.run(*plugins)
 
-    stage = Stage(
-        components=components, loop=loop, signals=signals, cancel_timeout=cancel_timeout
-    )
-    return stage.run(*plugins)
 
+class PreloadSignals(Signals):
+    """Signals are handled by the stages running the preloaded plugins."""
 
-async def run(tasks, *, evt_cancel=None, cancel_timeout: float = 60.0):
-    if evt_cancel is None:
-        evt_cancel = context.add(Cancel())
+    handlers = ()
 
-    unshielded_tasks = list(map(asyncio.create_task, tasks))
 
-    fut_tasks = asyncio.gather(
-        *map(asyncio.shield, unshielded_tasks),
-        return_exceptions=True,
-    )
+class Preload:
+    """Load plugins once, before several stages run on top of them.
 
-    # stop staging if we finish in any way
-    fut_tasks.add_done_callback(lambda _: evt_cancel.set())
+    Every stage shares the plugin context layer of the preloaded plugins
+    read-only and only loads the remaining plugins and creates their tasks.
 
-    # wait for exit
-    await evt_cancel.wait()
+    Preloaded plugins must not yield tasks, since their event loop is not the
+    one of the stages. Their teardown runs, when all stages finished.
+    """
 
-    sl.info("Shutdown", tasks=unshielded_tasks)
-    # INFO: we wait for shutdown of tasks
-    try:
-        return await asyncio.wait_for(fut_tasks, cancel_timeout)
-    except TimeoutError:
-        # INFO: find the ungraceful tasks and cancel them
-        ungraceful_tasks = [task for task in unshielded_tasks if not task.done()]
-        sl.warn("Cancelling ungraceful tasks", tasks=ungraceful_tasks)
-        for task in ungraceful_tasks:
-            task.cancel()
-            # INFO: let the task finish/deal with cancel
+    def __init__(
+        self,
+        *plugins,
+        components: t.Optional[Components] = None,
+        loop: t.Optional[asyncio.AbstractEventLoop] = None,
+        loop_factory: t.Optional[t.Callable[[], asyncio.AbstractEventLoop]] = None,
+    ):
+        if components is None:
+            components = Components()
+        self.stage = Stage(
+            components=components,
+            loop=loop,
+            signals=PreloadSignals,
+            loop_factory=loop_factory,
+        )
+        try:
+            self.stage.load(*plugins)
+            tasks = list(self.stage.loader.tasks)
+            if tasks:
+                raise RuntimeError("Preloaded plugins must not yield tasks", tasks)
+        except BaseException:
+            self.close()
+            raise
+
+        # INFO: the shared plugin context layer is put on top of the components
+        self.components = components.push(self.stage.context.stack[0])
+        self.loaded = self.stage.loader.plugins
+
+    def close(self):
+        try:
+            self.stage.run_teardown()
+        finally:
+            self.stage.close()
+
+
+class Threads:
+    """Run a stage on its own event loop in each of `number` threads.
+
+    All stages share the passed `components` and the plugin context layer of
+    the `preload` plugins read-only, see :py:obj:`Preload`, while every stage
+    has its own management, plugin and task context layers. Plugins yielding
+    tasks are loaded by every stage, since their tasks run on its loop.
+    SIGINT is forwarded to all stages by the main thread, so the stages handle
+    no signals themselves. If a stage fails, all other stages are cancelled.
+    """
+
+    def __init__(self, number: int = 0):
+        self.number = number
+        self.stages: t.List[t.Optional[Stage]] = []
+        self.cancelled = False
+        # INFO: guards the creation and closing of the stage loops against
+        # a concurrent cancel
+        self._lock = threading.RLock()
+
+    def run(
+        self,
+        *plugins,
+        components=None,
+        loop_factory: t.Optional[t.Callable[[], asyncio.AbstractEventLoop]] = None,
+        preload: t.Sequence = (),
+        **stage_kwargs,
+    ) -> t.List[t.Any]:
+        """Run all stages and return their results resp. exceptions.
+
+        :param preload: plugins to load once for all stages
+        """
+        for name in ("loop", "signals"):
+            if name in stage_kwargs:
+                raise TypeError(f"Threads provide the `{name}` of every stage", name)
+        number = self.number or len(os.sched_getaffinity(0))
+        if loop_factory is None:
+            loop_factory = configured_loop_factory(components)
+
+        if preload:
+            pre = Preload(*preload, components=components, loop_factory=loop_factory)
             try:
-                await task
-            except asyncio.CancelledError:
-                pass
+                return self.run(
+                    *plugins,
+                    components=pre.components,
+                    loop_factory=loop_factory,
+                    loaded=pre.loaded,
+                    **stage_kwargs,
+                )
+            finally:
+                pre.close()
+
+        self.stages = [None] * number
+        self.cancelled = False
+        results: t.List[t.Any] = [None] * number
 
+        def _run(i):
+            try:
+                with self._lock:
+                    stage = self.stages[i] = Stage(
+                        components=components,
+                        loop=loop_factory(),
+                        signals=ThreadSignals,
+                        **stage_kwargs,
+                    )
+                    if self.cancelled:
+                        stage.cancel.set()
+                try:
+                    results[i] = stage.run(*plugins)
+                finally:
+                    with self._lock:
+                        stage.loop.close()
+            except Exception as ex:
+                sl.error("Stage failed", thread=i, exc_info=ex)
+                results[i] = ex
+                # INFO: the other stages would keep running until SIGINT
+                self.cancel()
+
+        threads = [
+            threading.Thread(
+                # INFO: every thread needs its own copy of the context
+                target=contextvars.copy_context().run,
+                args=(_run, i),
+                name=f"buvar-stage-{i}",
+            )
+            for i in range(number)
+        ]
+        is_main_thread = threading.current_thread() is threading.main_thread()
+        if is_main_thread:
+            previous_handler = signal.signal(signal.SIGINT, self.cancel)
+        sl.debug("Starting threads", threads=number)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if is_main_thread:
+                signal.signal(signal.SIGINT, previous_handler)
+        return results
+
+    def cancel(self, *_):
+        """Cancel all running stages and those, which are not created yet."""
+        with self._lock:
+            self.cancelled = True
+            for stage in self.stages:
+                if stage is not None and not stage.loop.is_closed():
+                    stage.loop.call_soon_threadsafe(stage.cancel.set)
+
+
+class Tasks:
+    """Track the stage tasks directly and shut them down gracefully.
+
+    The cancel event is set, when all tasks are done. The shutdown duration of
+    every task, which finishes after the shutdown started, is recorded.
+    """
+
+    def __init__(self, evt_cancel: asyncio.Event):
+        self.evt_cancel = evt_cancel
+        self.tasks: t.List[asyncio.Task] = []
+        self.pending = 0
+        self.durations: t.Dict[asyncio.Task, float] = {}
+        self.shutdown_started: t.Optional[float] = None
+        self._all_done: t.Optional[asyncio.Future] = None
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def create_task(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tasks.append(task)
+        self.pending += 1
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task: asyncio.Task):
+        self.pending -= 1
+        if self.shutdown_started is not None:
+            self.durations[task] = task.get_loop().time() - self.shutdown_started
+        if not self.pending:
+            # stop staging if we finish in any way
+            self.evt_cancel.set()
+            if self._all_done is not None and not self._all_done.done():
+                self._all_done.set_result(None)
+
+    async def shutdown(self, timeout: float) -> t.List[asyncio.Task]:
+        """Wait `timeout` for all tasks to finish and cancel the ungraceful ones."""
+        loop = asyncio.get_running_loop()
+        self.shutdown_started = loop.time()
+        if self.pending:
+            self._all_done = loop.create_future()
+            await asyncio.wait((self._all_done,), timeout=timeout)
+
+        # INFO: find the ungraceful tasks and cancel them
+        ungraceful_tasks = [task for task in self.tasks if not task.done()]
+        if ungraceful_tasks:
+            sl.warn("Cancelling ungraceful tasks", tasks=ungraceful_tasks)
+            for task in ungraceful_tasks:
+                task.cancel()
+            # INFO: let the tasks finish/deal with cancel
+            await asyncio.wait(ungraceful_tasks)
+        if self.durations:
+            slowest = max(self.durations, key=self.durations.__getitem__)
+            sl.info(
+                "Tasks shut down",
+                count=len(self.durations),
+                slowest=slowest,
+                duration=self.durations[slowest],
+            )
+        return ungraceful_tasks
+
+    def results(self) -> t.List[t.Any]:
         results = []
-        for task in unshielded_tasks:
+        for task in self.tasks:
             try:
                 results.append(task.result())
             # INFO: we return CancelledError like other exceptions
@@ -303,31 +868,224 @@ async def run(tasks, *, evt_cancel=None, cancel_timeout: float = 60.0):
         return results
 
 
+async def run(
+    tasks,
+    *,
+    evt_cancel=None,
+    cancel_timeout: float = 60.0,
+    lifecycle: t.Optional[Lifecycle] = None,
+):
+    if evt_cancel is None:
+        evt_cancel = context.add(Cancel())
+    if lifecycle is None:
+        lifecycle = context.get(Lifecycle, default=None)
+        if lifecycle is None:
+            lifecycle = context.add(Lifecycle())
+
+    stage_tasks = context.add(Tasks(evt_cancel))
+    for task in tasks:
+        if isinstance(task, Supervised):
+            supervisor = stage_tasks.create_task(task.supervise(evt_cancel))
+            if task.critical:
+                supervisor.add_done_callback(lambda _: evt_cancel.set())
+        else:
+            stage_tasks.create_task(task)
+
+    if not stage_tasks.pending:
+        evt_cancel.set()
+
+    lifecycle.set(State.READY)
+    # wait for exit
+    await evt_cancel.wait()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + cancel_timeout
+    lifecycle.set(State.DRAINING)
+    if lifecycle.in_flight_count:
+        sl.info("Draining", in_flight=lifecycle.in_flight_count)
+        try:
+            await asyncio.wait_for(lifecycle.drained(), cancel_timeout)
+        except TimeoutError:
+            sl.warn("Drain timed out", in_flight=lifecycle.in_flight_count)
+
+    lifecycle.set(State.STOPPING)
+    sl.info("Shutdown", tasks=stage_tasks.tasks)
+    # INFO: we wait for shutdown of tasks
+    await stage_tasks.shutdown(max(deadline - loop.time(), 0))
+    return stage_tasks.results()
+
+
+class PluginInfo:
+    """Metadata of a plugin function, which is gathered only once."""
+
+    __slots__ = ("name", "hints", "is_async_gen")
+
+    def __init__(self, func: t.Callable):
+        # INFO: we must not reference func, since it is the weak key
+        self.name = util.fqdn(func)
+        self.is_async_gen = inspect.isasyncgenfunction(func)
+        if not (self.is_async_gen or inspect.iscoroutinefunction(func)):
+            raise ValueError(f"{func} must a coroutine or an async generator.")
+        self.hints = {
+            name: cls
+            for name, cls in t.get_type_hints(func).items()
+            if name != "return"
+        }
+
+
+_plugin_infos = weakref.WeakKeyDictionary()
+
+
+def plugin_info(plugin: t.Callable) -> PluginInfo:
+    """Return the cached :py:obj:`PluginInfo` of a plugin function."""
+    try:
+        return _plugin_infos[plugin]
+    except KeyError:
+        info = _plugin_infos[plugin] = PluginInfo(plugin)
+        return info
+
+
 def collect_plugin_args(plugin):
-    hints = t.get_type_hints(plugin)
+    hints = plugin_info(plugin).hints
     args = {name: context.get(cls) for name, cls in hints.items()}
     return args
 
 
+async def resolve_plugin_args(info: PluginInfo):
+    """Lookup plugin arguments in the context or create them via adapters."""
+    args = {}
+    for name, cls in info.hints.items():
+        try:
+            args[name] = context.get(cls)
+        except components.ComponentLookupError as ex:
+            try:
+                args[name] = await di.nject(cls)
+            except di.ResolveError:
+                raise ex
+    return args
+
+
 def resolve_plugin_func(
     plugin,
     *,
     function_name: str = PLUGIN_FUNCTION_NAME,
     caller: t.Union[types.FrameType, int] = 0,
 ) -> t.Callable:
-    plugin = util.resolve_dotted_name(
-        plugin, caller=(caller + 1) if isinstance(caller, int) else caller
-    )
+    if isinstance(plugin, str):
+        frame = (
+            caller if isinstance(caller, types.FrameType) else sys._getframe(1 + caller)
+        )
+        # relative names depend on the calling package
+        return resolve_plugin_name(
+            plugin,
+            frame.f_globals["__package__"] if plugin.startswith(".") else None,
+            function_name,
+        )
+
     if inspect.ismodule(plugin):
         # apply default name
         plugin = getattr(plugin, function_name)
 
-    if not (inspect.iscoroutinefunction(plugin) or inspect.isasyncgenfunction(plugin)):
-        raise ValueError(f"{plugin} must a coroutine or an async generator.")
-
+    # validates the plugin function
+    plugin_info(plugin)
     return plugin
 
 
+@functools.lru_cache(maxsize=1024)
+def resolve_plugin_name(
+    name: str,
+    package: t.Optional[str] = None,
+    function_name: str = PLUGIN_FUNCTION_NAME,
+) -> t.Callable:
+    """Resolve and cache a plugin by its dotted `name`.
+
+    Call `resolve_plugin_name.cache_clear()` after a plugin module was reloaded.
+    """
+    return resolve_plugin_func(
+        util.resolve_dotted_name(name, package=package), function_name=function_name
+    )
+
+
+def plugin_index_path(group: str = PLUGIN_ENTRY_POINT_GROUP) -> str:
+    """Return the path of the on-disk plugin index for an entry point group."""
+    path = os.environ.get(PLUGIN_INDEX_ENV)
+    if path:
+        return path
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "buvar", f"{group}.json")
+
+
+def distributions_key() -> t.List[t.List[t.Any]]:
+    """Fingerprint the installed distributions without parsing their metadata.
+
+    The key lists the metadata directories of all import paths with the
+    mtimes of their entry points, which change with an (editable) install.
+    """
+    key = []
+    for path in sys.path:
+        try:
+            entries = sorted(os.scandir(path or "."), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if not entry.name.endswith((".dist-info", ".egg-info")):
+                continue
+            try:
+                mtime = os.stat(
+                    os.path.join(entry.path, "entry_points.txt")
+                ).st_mtime_ns
+            except OSError:
+                mtime = None
+            key.append([entry.path, mtime])
+    return key
+
+
+def discover_plugins(
+    group: str = PLUGIN_ENTRY_POINT_GROUP, *, index: t.Union[str, bool, None] = None
+) -> t.Dict[str, str]:
+    """Discover plugins via a package entry point group.
+
+    The result maps entry point names to dotted plugin names and is cached in
+    an on-disk index, until the installed distributions change.
+
+    :param group: the entry point group
+    :param index: the index path, `None` for the default path or `False` to
+        disable the index
+    """
+    if index is None:
+        index = plugin_index_path(group)
+    key = distributions_key()
+
+    if index:
+        try:
+            with open(index) as f:
+                cached = json.load(f)
+            if cached["key"] == key:
+                return cached["plugins"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    plugins = {
+        ep.name: f"{ep.module}:{ep.attr}" if ep.attr else ep.module
+        for ep in sorted(
+            importlib.metadata.entry_points(group=group), key=lambda ep: ep.name
+        )
+    }
+    sl.debug("Discovered plugins", group=group, plugins=plugins)
+
+    if index:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(index)), exist_ok=True)
+            tmp = f"{index}.{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump({"key": key, "plugins": plugins}, f)
+            # INFO: forked workers may race for the index
+            os.replace(tmp, index)
+        except OSError as ex:
+            sl.warning("Plugin index not written", index=index, error=ex)
+    return plugins
+
+
 async def generate_async_result(fun_result):
     """Create an async generator out of any result."""
     if inspect.isasyncgen(fun_result):
@@ -0,0 +1,235 @@
+"""A process pool to offload CPU heavy work from the event loop.
+
+Large :py:obj:`bytes` arguments and results are transferred via shared memory
+instead of pickling them through a pipe. The number of pending jobs is
+limited, so that a submitting task waits, until the pool catches up.
+
+In a child of :py:obj:`buvar.fork.stage` every child starts its own pool, so
+the unpinned children share the CPUs. The pool cannot be preloaded in the
+parent, since its threads do not survive a fork.
+
+    >>> def sha256(data: bytes) -> bytes:
+    ...     # a module level function, since it is pickled
+    ...     return hashlib.sha256(data).digest()
+    >>>
+    >>> async def prepare(load: plugin.Loader):
+    ...     await load("buvar.plugins.pool")
+    ...
+    ...     async def task():
+    ...         workers = await di.nject(Pool)
+    ...         digest = await workers.submit(sha256, b"..." * 1000000)
+    ...
+    ...     yield task()
+"""
+
+import asyncio
+import concurrent.futures
+import dataclasses as dc
+import functools
+import multiprocessing
+import os
+import signal
+import typing as t
+from multiprocessing import shared_memory
+
+import structlog
+
+from buvar import config, context, di, fork, plugin
+
+sl = structlog.get_logger()
+
+
+@dc.dataclass
+class PoolConfig(config.Config, section="pool"):
+    """Configure the process pool.
+
+    :param workers: the number of processes, all CPUs by default resp. all
+        CPUs divided by the number of unpinned forked workers
+    :param max_pending: the number of submitted but unfinished jobs, two per
+        worker by default
+    :param start_method: `fork`, `forkserver` or `spawn`, forking a process
+        with threads, e.g. of a log queue, risks deadlocks
+    :param shm_threshold: `bytes` of at least this size are transferred via
+        shared memory
+    :param prestart: start all workers at once
+    """
+
+    workers: int = 0
+    max_pending: int = 0
+    start_method: str = "forkserver"
+    shm_threshold: int = 1 << 20
+    prestart: bool = True
+
+
+class SharedBytes(t.NamedTuple):
+    """A handle to bytes in shared memory."""
+
+    name: str
+    size: int
+
+    @classmethod
+    def create(cls, data) -> "SharedBytes":
+        data = memoryview(data).cast("B")
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        try:
+            shm.buf[: data.nbytes] = data
+        finally:
+            shm.close()
+        return cls(shm.name, data.nbytes)
+
+    def read(self, *, unlink: bool = False) -> bytes:
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            return bytes(shm.buf[: self.size])
+        finally:
+            shm.close()
+            if unlink:
+                shm.unlink()
+
+    def unlink(self):
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+def _share(value, threshold: int):
+    if isinstance(value, (bytes, bytearray, memoryview)) and (
+        memoryview(value).nbytes >= threshold
+    ):
+        return SharedBytes.create(value)
+    return value
+
+
+def _init_worker():
+    # INFO: the stage owning the pool handles the signals and shuts the pool
+    # down via its teardown, but a worker terminated with its process group
+    # exits at once
+    for signum in fork.FORWARD_SIGNALS:
+        signal.signal(
+            signum, signal.SIG_DFL if signum == signal.SIGTERM else signal.SIG_IGN
+        )
+
+
+def _call(func, args, kwargs, threshold):
+    args = [arg.read() if isinstance(arg, SharedBytes) else arg for arg in args]
+    kwargs = {
+        key: value.read() if isinstance(value, SharedBytes) else value
+        for key, value in kwargs.items()
+    }
+    return _share(func(*args, **kwargs), threshold)
+
+
+def _unlink(shared: t.Iterable[SharedBytes]):
+    for shared_bytes in shared:
+        shared_bytes.unlink()
+
+
+def _discard(shared: t.List[SharedBytes], job: concurrent.futures.Future):
+    """Release the shared memory of an abandoned job."""
+    if not job.cancelled() and job.exception() is None:
+        result = job.result()
+        if isinstance(result, SharedBytes):
+            result.unlink()
+    _unlink(shared)
+
+
+class PoolFull(Exception):
+    """There are too many pending jobs."""
+
+
+class Pool:
+    """A process pool, which is used from the event loop.
+
+    :param shares: the number of processes, which share the CPUs for their
+        pools
+    """
+
+    def __init__(self, pool_config: t.Optional[PoolConfig] = None, shares: int = 1):
+        self.config = pool_config or PoolConfig()
+        self.workers = self.config.workers or max(
+            1, len(os.sched_getaffinity(0)) // shares
+        )
+        self.max_pending = self.config.max_pending or 2 * self.workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context(self.config.start_method),
+            initializer=_init_worker,
+        )
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self.pending = 0
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    async def start(self):
+        """Start all worker processes."""
+        await asyncio.gather(*(self.submit(os.getpid) for _ in range(self.workers)))
+        sl.info("Started process pool", workers=self.workers)
+
+    async def submit(self, func: t.Callable, *args, wait: bool = True, **kwargs):
+        """Run `func` in a worker process and return its result.
+
+        :param wait: wait for a free slot, if there are too many pending jobs,
+            or raise :py:obj:`PoolFull`
+        """
+        if not wait and self.full:
+            raise PoolFull(self.pending, self.max_pending)
+        async with self._slots:
+            self.pending += 1
+            threshold = self.config.shm_threshold
+            shared_args = [_share(arg, threshold) for arg in args]
+            shared_kwargs = {
+                key: _share(value, threshold) for key, value in kwargs.items()
+            }
+            shared = [
+                arg
+                for arg in (*shared_args, *shared_kwargs.values())
+                if isinstance(arg, SharedBytes)
+            ]
+            try:
+                # INFO: a shut down or broken pool refuses the job
+                job = self.executor.submit(
+                    _call, func, shared_args, shared_kwargs, threshold
+                )
+                result = await asyncio.wrap_future(job)
+            except asyncio.CancelledError:
+                # INFO: a running job is not cancelled, so its shared memory
+                # is released, when it is done
+                job.add_done_callback(functools.partial(_discard, shared))
+                raise
+            except BaseException:
+                _unlink(shared)
+                raise
+            finally:
+                self.pending -= 1
+        _unlink(shared)
+        if isinstance(result, SharedBytes):
+            return result.read(unlink=True)
+        return result
+
+    async def shutdown(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, lambda: self.executor.shutdown(wait=True, cancel_futures=True)
+        )
+        sl.info("Stopped process pool")
+
+
+async def prepare(load: plugin.Loader, teardown: plugin.Teardown):
+    await load(config)
+    pool_config = await di.nject(PoolConfig)
+    # INFO: a pinned forked worker has only its own CPUs
+    forked = context.get(fork.Fork, default=None)
+    shares = (
+        forked.forks
+        if forked is not None and forked.is_child and forked.affinity is None
+        else 1
+    )
+    pool = context.add(Pool(pool_config, shares=shares))
+    if pool_config.prestart:
+        await pool.start()
+    teardown.add(pool.shutdown(), name="pool")
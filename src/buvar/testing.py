@@ -48,16 +48,19 @@ def buvar_context(buvar_config_source):
 
 
 @pytest.fixture
-async def buvar_stage_loop(): ...
+async def buvar_stage_loop():
+    import asyncio
+
+    return asyncio.get_running_loop()
 
 
 @pytest.fixture
 def buvar_stage(buvar_context, buvar_stage_loop):
-    # INFO: we need to depend on an async fixture, since Stage attaches to asyncio.get_event_loop()
-    # pytest-asyncio would otherwise use another loop for the specific test
+    # INFO: we need to depend on an async fixture to get the loop of the test,
+    # since the stage would otherwise create its own loop
     from buvar import plugin
 
-    stage = plugin.Stage(components=buvar_context)
+    stage = plugin.Stage(components=buvar_context, loop=buvar_stage_loop)
     return stage
 
 
@@ -40,38 +40,78 @@ class cached:
 def merge_dict(*sources, dest=None):
     """Merge `sources` into `dest`.
 
-    `dest` is altered in place.
+    `dest` is altered in place, nested dicts of `sources` are copied.
     """
     if dest is None:
         dest = {}
-    for source in sources:
-        for key, value in source.items():
+    # INFO: a stack of item iterators walks the trees depth first in the same
+    # order as recursion would do, without hitting the recursion limit
+    stack = [(dest, iter(source.items())) for source in reversed(sources)]
+    while stack:
+        node, items = stack[-1]
+        for key, value in items:
             if isinstance(value, dict):
                 # get node or create one
-                node = dest.setdefault(key, {})
-                merge_dict(value, dest=node)
-            else:
-                dest[key] = value
+                stack.append((node.setdefault(key, {}), iter(value.items())))
+                break
+            node[key] = value
+        else:
+            stack.pop()
+    return dest
+
+
+def merged(*sources) -> dict:
+    """Merge `sources` into a new dict.
+
+    Subtrees, which are not altered by a later source, are shared with the
+    sources and not copied. So the result must not be altered in place.
+    """
+    dest: dict = {}
+    # nodes created by us, which may be altered
+    owned = {id(dest)}
+    stack = [(dest, iter(source.items())) for source in reversed(sources)]
+    while stack:
+        node, items = stack[-1]
+        for key, value in items:
+            if isinstance(value, dict):
+                child = node.get(key)
+                if isinstance(child, dict):
+                    if id(child) not in owned:
+                        # copy on write
+                        child = node[key] = dict(child)
+                        owned.add(id(child))
+                    stack.append((child, iter(value.items())))
+                    break
+            node[key] = value
+        else:
+            stack.pop()
     return dest
 
 
 def resolve_dotted_name(
-    name: str, *, caller: t.Union[types.FrameType, int] = 0
+    name: str,
+    *,
+    caller: t.Union[types.FrameType, int] = 0,
+    package: t.Optional[str] = None,
 ) -> t.Union[types.ModuleType, t.Callable]:
-    """Use pkg_resources style dotted name to resolve a name."""
+    """Use pkg_resources style dotted name to resolve a name.
+
+    A relative name is resolved against `package` or the package of the
+    caller.
+    """
     # skip resolving for module and coroutine
     if inspect.ismodule(name) or inspect.isroutine(name) or not isinstance(name, str):
         return name
 
     # relative import
-    if name.startswith("."):
+    if name.startswith(".") and package is None:
         # find coller package
         frame = (
             caller if isinstance(caller, types.FrameType) else sys._getframe(1 + caller)
         )
         caller_package = frame.f_globals["__package__"]
     else:
-        caller_package = None
+        caller_package = package
 
     part = ":"
     module_name, _, attr_name = name.partition(part)
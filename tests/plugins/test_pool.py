@@ -0,0 +1,179 @@
+import pytest
+
+
+def double(data, times=2):
+    return data * times
+
+
+def shm_count():
+    import os
+
+    return len(os.listdir("/dev/shm"))
+
+
+@pytest.mark.asyncio
+async def test_pool_submit():
+    from buvar.plugins import pool
+
+    p = pool.Pool(pool.PoolConfig(workers=2, shm_threshold=1024))
+    try:
+        assert await p.submit(double, 21) == 42
+        assert await p.submit(double, b"a", times=3) == b"aaa"
+    finally:
+        await p.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_pool_shared_memory():
+    from buvar.plugins import pool
+
+    before = shm_count()
+    p = pool.Pool(pool.PoolConfig(workers=1, shm_threshold=1024))
+    try:
+        data = b"x" * 4096
+        assert await p.submit(double, data) == data * 2
+        assert await p.submit(double, b"y" * 600) == b"y" * 1200
+    finally:
+        await p.shutdown()
+    assert shm_count() == before
+
+
+@pytest.mark.asyncio
+async def test_pool_submit_after_shutdown():
+    from buvar.plugins import pool
+
+    before = shm_count()
+    p = pool.Pool(pool.PoolConfig(workers=1, shm_threshold=1024))
+    await p.shutdown()
+    with pytest.raises(RuntimeError):
+        await p.submit(double, b"x" * 4096)
+    assert p.pending == 0
+    assert shm_count() == before
+
+
+def running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rpartition(")")[2].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.asyncio
+async def test_pool_worker_signals():
+    import asyncio
+    import os
+    import signal
+
+    from buvar.plugins import pool
+
+    p = pool.Pool(pool.PoolConfig(workers=1))
+    try:
+        pid = await p.submit(os.getpid)
+        os.kill(pid, signal.SIGINT)
+        await asyncio.sleep(0.1)
+        assert running(pid)
+
+        os.kill(pid, signal.SIGTERM)
+        for _ in range(50):
+            if not running(pid):
+                break
+            await asyncio.sleep(0.02)
+        assert not running(pid)
+    finally:
+        await p.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_pool_backpressure():
+    import asyncio
+    import time
+
+    from buvar.plugins import pool
+
+    p = pool.Pool(pool.PoolConfig(workers=1, max_pending=1))
+    try:
+        job = asyncio.create_task(p.submit(time.sleep, 0.2))
+        await asyncio.sleep(0)
+        assert p.full
+        with pytest.raises(pool.PoolFull):
+            await p.submit(double, 1, wait=False)
+        assert await p.submit(double, 1) == 2
+        assert job.done()
+        assert p.pending == 0
+    finally:
+        await p.shutdown()
+
+
+def test_pool_plugin():
+    from buvar import config, context, di, plugin
+    from buvar.plugins import pool
+
+    results = []
+
+    async def prepare(load: plugin.Loader):
+        context.add(config.ConfigSource({"pool": {"workers": 1}}))
+        await load(pool)
+
+        async def task():
+            p = await di.nject(pool.Pool)
+            results.append((p.workers, await p.submit(double, 3)))
+
+        yield task()
+
+    plugin.stage(prepare)
+    assert results == [(1, 6)]
+
+
+def sleep_and_share(data):
+    import time
+
+    time.sleep(0.2)
+    return data
+
+
+@pytest.mark.asyncio
+async def test_pool_cancelled_shared_memory():
+    import asyncio
+
+    from buvar.plugins import pool
+
+    before = shm_count()
+    p = pool.Pool(pool.PoolConfig(workers=1, shm_threshold=1024))
+    try:
+        job = asyncio.create_task(p.submit(sleep_and_share, b"x" * 4096))
+        await asyncio.sleep(0.1)
+        job.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await job
+        assert p.pending == 0
+        # the running job still reads its argument
+        await asyncio.sleep(0.3)
+    finally:
+        await p.shutdown()
+    assert shm_count() == before
+
+
+def test_pool_forked_workers(mocker):
+    import os
+
+    from buvar import config, context, di, fork, plugin
+    from buvar.plugins import pool
+
+    mocker.patch("os.sched_getaffinity", return_value={0, 1, 2, 3})
+    parent = os.getpid()
+
+    async def prepare(load: plugin.Loader):
+        context.add(config.ConfigSource({"pool": {"prestart": False}}))
+        await load(pool)
+
+        async def task():
+            return (await di.nject(pool.Pool)).workers
+
+        yield task()
+
+    result = fork.stage(prepare, forks=2)
+    if os.getpid() != parent:
+        os._exit(0)
+
+    assert result == [[2], [2]]
@@ -350,3 +350,457 @@ async def test_dataclass_config_from_env(mocker):
 
     foo_config = await di.nject(Foo)
     assert foo_config == Foo("some string")
+
+
+def test_config_load_cached(mocker):
+    import attr
+
+    from buvar import config
+
+    @attr.s(auto_attribs=True)
+    class FooConfig:
+        bar: str
+        baz: int = 1
+
+    mocker.patch("os.environ", {})
+    env_config = mocker.spy(config.ConfigLoader, "env_config")
+    cfg = config.ConfigSource({"foo": {"bar": "abc"}}, env_prefix="PREFIX")
+
+    foo = cfg.load(FooConfig, "foo")
+    assert foo == FooConfig(bar="abc")
+    assert cfg.load(FooConfig, "foo") is foo
+    assert env_config.call_count == 1
+
+    # environment changed
+    mocker.patch("os.environ", {"PREFIX_FOO_BAZ": "2"})
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar="abc", baz=2)
+    assert env_config.call_count == 2
+
+    # value of an env var changed in place needs a new snapshot
+    environ = {"PREFIX_FOO_BAZ": "2"}
+    mocker.patch("os.environ", environ)
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar="abc", baz=2)
+    environ["PREFIX_FOO_BAZ"] = "3"
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar="abc", baz=2)
+    cfg.refresh_env()
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar="abc", baz=3)
+    environ["PREFIX_FOO_BAZ"] = "2"
+    cfg.refresh_env()
+
+    # source changed
+    cfg.merge({"foo": {"bar": "xyz"}})
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar="xyz", baz=2)
+    cfg["foo"] = {"bar": "123"}
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar="123", baz=2)
+    assert env_config.call_count == 5
+
+
+def test_config_load_env_patched_in_place():
+    import os
+
+    import attr
+    import mock
+
+    from buvar import config
+
+    @attr.s(auto_attribs=True)
+    class FooConfig:
+        bar: int = 1
+
+    cfg = config.ConfigSource({"foo": {}}, env_prefix="APP")
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar=1)
+    with mock.patch.dict(os.environ, {"APP_FOO_BAR": "5"}):
+        # the snapshot is taken once
+        assert cfg.load(FooConfig, "foo") == FooConfig(bar=1)
+        cfg.refresh_env()
+        assert cfg.load(FooConfig, "foo") == FooConfig(bar=5)
+    cfg.refresh_env()
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar=1)
+
+
+def test_config_load_cached_nested_change(mocker):
+    import attr
+
+    from buvar import config, util
+
+    @attr.s(auto_attribs=True)
+    class FooConfig:
+        bar: int
+
+    mocker.patch("os.environ", {})
+    cfg = config.ConfigSource({"foo": {"bar": 2}})
+    foo = cfg.load(FooConfig, "foo")
+    assert cfg.load(FooConfig, "foo") is foo
+
+    # a nested change in place needs an explicit invalidation
+    cfg["foo"]["bar"] = 5
+    assert cfg.load(FooConfig, "foo") is foo
+    cfg.invalidate("foo")
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar=5)
+
+    util.merge_dict({"foo": {"bar": 7}}, dest=cfg)
+    assert cfg.load(FooConfig, "foo") == FooConfig(bar=7)
+    assert cfg.load(FooConfig, "foo") is cfg.load(FooConfig, "foo")
+
+
+def test_env_index():
+    from buvar import config
+
+    env = config.EnvIndex(
+        {"APP_FOO_BAR": "1", "APP_FOO_BAZ_BAM": "2", "APP_BAR": "3", "OTHER": "4"},
+        prefixes=("app",),
+    )
+    assert sorted(env.find("app", "foo")) == [
+        ("APP_FOO_BAR", "1"),
+        ("APP_FOO_BAZ_BAM", "2"),
+    ]
+    assert sorted(env.find()) == [
+        ("APP_BAR", "3"),
+        ("APP_FOO_BAR", "1"),
+        ("APP_FOO_BAZ_BAM", "2"),
+    ]
+    assert list(env.find("other")) == []
+
+
+def test_applied_and_unmatched_env(mocker):
+    import attr
+
+    from buvar import config
+
+    @attr.s(auto_attribs=True)
+    class BazConfig:
+        bam: int = 0
+
+    @attr.s(auto_attribs=True)
+    class FooConfig:
+        bar: str = "bar"
+        baz: BazConfig = BazConfig()
+
+    mocker.patch(
+        "os.environ",
+        {"APP_FOO_BAZ_BAM": "2", "APP_FOO_BAZZ": "typo", "HOME": "/root"},
+    )
+    cfg = config.ConfigSource(env_prefix="APP")
+    assert cfg.load(FooConfig, "foo") == FooConfig(baz=BazConfig(bam=2))
+    assert cfg.applied_env == {"APP_FOO_BAZ_BAM": ("baz", "bam")}
+    assert cfg.unmatched_env() == {"APP_FOO_BAZZ"}
+
+
+def test_reloadable_config_source(tmp_path):
+    import os
+
+    import attr
+
+    from buvar import Components, config
+
+    @attr.s(auto_attribs=True)
+    class FooConfig(config.Config, section="foo"):
+        bar: str = "bar"
+
+    @attr.s(auto_attribs=True)
+    class BimConfig(config.Config, section="bim"):
+        bam: int = 0
+
+    path = tmp_path / "config.toml"
+    path.write_text('[foo]\nbar = "abc"\n\n[bim]\nbam = 1\n')
+
+    cfg = config.ReloadableConfigSource(str(path), defaults=[{"bim": {"bam": 0}}])
+    cmps = Components()
+    cfg.publish(cmps)
+    assert cmps.get(FooConfig) == FooConfig(bar="abc")
+    bim = cmps.get(BimConfig)
+    assert bim == BimConfig(bam=1)
+
+    notified = []
+    cfg.subscribe("foo", lambda source, section: notified.append(section))
+    cfg.subscribe(None, lambda source, section: notified.append(section))
+
+    # unchanged
+    assert cfg.check() == set()
+
+    path.write_text('[foo]\nbar = "xyz"\n\n[bim]\nbam = 1\n')
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert cfg.check() == {"foo"}
+    assert notified == ["foo", None]
+    assert cmps.get(FooConfig) == FooConfig(bar="xyz")
+    # untouched section is not structured again
+    assert cmps.get(BimConfig) is bim
+    assert cfg.load(BimConfig, "bim") is bim
+
+
+@pytest.mark.asyncio
+async def test_reloadable_config_source_watch(tmp_path):
+    import asyncio
+
+    from buvar import config
+
+    path = tmp_path / "config.toml"
+    cfg = config.ReloadableConfigSource(str(path))
+    assert cfg == {}
+
+    cancel = asyncio.Event()
+    changed = []
+
+    def notify(source, section):
+        changed.append(section)
+        cancel.set()
+
+    cfg.subscribe("foo", notify)
+    watch = asyncio.create_task(cfg.watch(0.01, cancel=cancel))
+    await asyncio.sleep(0)
+    path.write_text('[foo]\nbar = "abc"\n')
+    await asyncio.wait_for(watch, 1)
+    assert changed == ["foo"]
+    assert cfg == {"foo": {"bar": "abc"}}
+
+
+@pytest.mark.parametrize(
+    "name, content",
+    [
+        ("config.toml", '[foo]\nbar = "abc"\n'),
+        ("config.json", '{"foo": {"bar": "abc"}}'),
+        ("config.yaml", "foo:\n  bar: abc\n"),
+    ],
+)
+def test_load_config_file(tmp_path, name, content):
+    from buvar import config
+
+    path = tmp_path / name
+    path.write_text(content)
+    assert config.load_config_file(str(path)) == {"foo": {"bar": "abc"}}
+
+
+def test_load_config_file_unsupported(tmp_path):
+    from buvar import config
+
+    with pytest.raises(config.ConfigError):
+        config.load_config_file(str(tmp_path / "config.ini"))
+
+
+def test_load_config_dir_lazy(tmp_path, mocker):
+    import attr
+
+    from buvar import config
+
+    @attr.s(auto_attribs=True)
+    class FooConfig:
+        bar: str
+        baz: int = 0
+
+    (tmp_path / "foo.toml").write_text('bar = "abc"\nbaz = 1\n')
+    (tmp_path / "10-foo.json").write_text('{"bar": "def"}')
+    (tmp_path / "bim.yaml").write_text("bam: 1\n")
+    (tmp_path / "README").write_text("ignored")
+
+    load = mocker.spy(config, "load_config_file")
+    source = config.ConfigSource(
+        {"foo": {"baz": 2}}, config.load_config_dir(str(tmp_path))
+    )
+    assert load.call_count == 0
+    assert "bim" in source
+
+    foo = source.load(FooConfig, "foo")
+    # fragments merge in file name order on top of present values
+    assert foo == FooConfig(bar="abc", baz=1)
+    assert sorted(call.args[0] for call in load.call_args_list) == [
+        str(tmp_path / "10-foo.json"),
+        str(tmp_path / "foo.toml"),
+    ]
+
+    assert source["bim"] == {"bam": 1}
+    assert load.call_count == 3
+
+
+def test_load_config_dir_lazy_order(tmp_path):
+    from buvar import config
+
+    (tmp_path / "foo.toml").write_text('bar = "from-dir"\nbaz = 1\n')
+
+    source = config.ConfigSource(
+        {"foo": {"baz": 0}},
+        config.load_config_dir(str(tmp_path)),
+        {"foo": {"bar": "override"}},
+    )
+    source.merge({"foo": {"bam": 2}})
+    assert source["foo"] == {"bar": "override", "baz": 1, "bam": 2}
+
+    source = config.ConfigSource(config.load_config_dir(str(tmp_path)))
+    source["foo"] = {"bar": "set"}
+    assert source["foo"] == {"bar": "set"}
+
+
+def test_load_config_dir_numeric_order(tmp_path):
+    from buvar import config
+
+    (tmp_path / "9-foo.json").write_text('{"bar": "nine", "baz": 9}')
+    (tmp_path / "10-foo.json").write_text('{"bar": "ten"}')
+    (tmp_path / "foo.json").write_text('{"bam": "plain"}')
+
+    source = config.ConfigSource(config.load_config_dir(str(tmp_path)))
+    assert source["foo"] == {"bar": "ten", "baz": 9, "bam": "plain"}
+
+
+def test_load_config_dir_lazy_mapping(tmp_path, mocker):
+    from buvar import config
+
+    (tmp_path / "foo.toml").write_text("bar = 1\n")
+
+    load = mocker.spy(config, "load_config_file")
+    source = config.ConfigSource({"a": 1}, config.load_config_dir(str(tmp_path)))
+    assert "foo" in source
+    assert list(source) == ["a", "foo"]
+    assert list(source.keys()) == ["a", "foo"]
+    assert len(source) == 2
+    assert load.call_count == 0
+
+    assert dict(source) == {"a": 1, "foo": {"bar": 1}}
+    assert list(source.items()) == [("a", 1), ("foo", {"bar": 1})]
+    assert load.call_count == 1
+    assert len(source) == 2
+
+    source = config.ConfigSource(config.load_config_dir(str(tmp_path)))
+    assert source.replace({"foo": {"bar": 1}}) == set()
+    assert source.replace({"a": 1}) == {"a", "foo"}
+    assert dict(source) == {"a": 1}
+
+
+def test_generate_env_help_dataclass():
+    import dataclasses
+
+    from buvar import config
+
+    @dataclasses.dataclass
+    class BarConfig:
+        bam: int = 1
+
+    @dataclasses.dataclass
+    class FooConfig:
+        bar: BarConfig
+        baz: str = "baz"
+
+    assert set(config.generate_env_help(FooConfig, "app").splitlines()) == {
+        "APP_BAR_BAM",
+        "APP_BAZ",
+    }
+
+
+def test_config_schema(mocker):
+    import dataclasses
+    import io
+    import json
+    import typing
+
+    import attr
+
+    from buvar import config
+
+    mocker.patch.dict(config.Config.__buvar_config_sections__, clear=True)
+
+    @attr.s(auto_attribs=True)
+    class FooConfig(config.Config, section="foo"):
+        bar: str
+        baz: typing.List[int] = attr.ib(factory=list)
+
+    @dataclasses.dataclass
+    class BimConfig(config.Config, section="bim"):
+        bam: float = 1.5
+
+    schema = config.ConfigSchema(env_prefix="app")
+    assert {(section, field.env_name) for section, field in schema.fields} == {
+        ("foo", "APP_FOO_BAR"),
+        ("foo", "APP_FOO_BAZ"),
+        ("bim", "APP_BIM_BAM"),
+    }
+    assert set(schema.env_help().splitlines()) == {
+        "APP_FOO_BAR",
+        "APP_FOO_BAZ",
+        "APP_BIM_BAM",
+    }
+
+    fp = io.StringIO()
+    schema.dump(fp)
+    assert sorted(json.loads(fp.getvalue()), key=lambda f: f["env"]) == [
+        {
+            "section": "bim",
+            "path": ["bam"],
+            "env": "APP_BIM_BAM",
+            "type": "float",
+            "required": False,
+            "default": 1.5,
+        },
+        {
+            "section": "foo",
+            "path": ["bar"],
+            "env": "APP_FOO_BAR",
+            "type": "str",
+            "required": True,
+        },
+        {
+            "section": "foo",
+            "path": ["baz"],
+            "env": "APP_FOO_BAZ",
+            "type": "List[int]",
+            "required": False,
+            "default": [],
+        },
+    ]
+
+    # the schema shares the compiled loaders of the config source
+    source = config.ConfigSource({"foo": {"bar": "x"}}, env_prefix="app")
+    source.load(FooConfig, "foo")
+    assert (
+        config.compile_config_loader(FooConfig, ("app", "foo"))
+        is (schema.loaders["foo"])
+    )
+
+
+def test_config_schema_skips_init_false():
+    import dataclasses
+
+    import attr
+
+    from buvar import config
+
+    @dataclasses.dataclass
+    class FooConfig:
+        bar: int = 1
+        handle: object = dataclasses.field(default=None, init=False)
+
+    @attr.s(auto_attribs=True)
+    class BimConfig:
+        bam: int = 1
+        handle: object = attr.ib(default=None, init=False)
+
+    schema = config.ConfigSchema({"foo": FooConfig, "bim": BimConfig}, env_prefix="APP")
+    assert schema.env_help().split() == ["APP_FOO_BAR", "APP_BIM_BAM"]
+
+    source = config.ConfigSource({"foo": {"bar": 2}}, env_prefix="APP")
+    assert source.load(FooConfig, "foo") == FooConfig(bar=2)
+
+
+def test_config_load_later_structure_hook(monkeypatch):
+    import attr
+
+    from buvar import config
+
+    # INFO: do not leak the hook into other tests
+    converter = config.relaxed_converter.copy()
+    monkeypatch.setattr(config, "relaxed_converter", converter)
+    monkeypatch.setattr(config, "converter", converter)
+
+    class Port(int):
+        pass
+
+    @attr.s(auto_attribs=True)
+    class PortConfig:
+        port: Port
+
+    cfg = config.ConfigSource({"port": {"port": 8}})
+    assert cfg.load(PortConfig, "port") == PortConfig(port=8)
+
+    config.relaxed_converter.register_structure_hook(
+        Port, lambda value, _: Port(int(value) + 1000)
+    )
+    cfg["port"] = {"port": 8}
+    assert cfg.load(PortConfig, "port") == PortConfig(port=1008)
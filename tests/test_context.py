@@ -90,3 +90,25 @@ def test_global_context_child():
         assert context.get(str) == "bar"
         assert context.get(int) == 123
     assert context.get(str) == "foo"
+
+
+@pytest.mark.asyncio
+async def test_tasks_context_explicit_no_stacking():
+    import asyncio
+    import contextvars
+
+    from buvar import context
+
+    factory = context.set_task_factory()
+
+    try:
+        context_size = len(context.current_context().stack)
+
+        async def task():
+            return len(context.current_context().stack)
+
+        stacked = await asyncio.create_task(task())
+        explicit = await asyncio.create_task(task(), context=contextvars.copy_context())
+        assert (stacked, explicit) == (context_size + 1, context_size)
+    finally:
+        factory.reset()
@@ -7,14 +7,103 @@ def test_forked_parent(mocker):
 
     mocker.patch("os.getpid", return_value=1)
     mock_pgid = mocker.patch("os.getpgid", return_value=2)
-    mock_waitid = mocker.patch("os.waitid")
-    mocker.patch("os.fork", return_value=123)
+    mock_waitid = mocker.patch(
+        "os.waitid",
+        side_effect=[
+            mocker.Mock(si_pid=pid, si_code=os.CLD_EXITED, si_status=0)
+            for pid in (123, 124)
+        ],
+    )
+    mocker.patch("os.fork", side_effect=[123, 124])
     f = fork.Fork(2)
     f.run(lambda x: x)
 
     mock_pgid.assert_called_with(1)
     mock_waitid.assert_called_with(os.P_PGID, 2, os.WEXITED)
-    assert f.children == {123}
+    assert f.children == set()
+
+
+def test_forked_respawn(mocker):
+    import os
+    import signal
+
+    from buvar import fork
+
+    mocker.patch("os.getpgid", return_value=2)
+    mocker.patch("os.kill")
+    mock_fork = mocker.patch("os.fork", side_effect=[101, 102, 103])
+    f = fork.Fork(2, backoff=0)
+
+    def exits():
+        # worker 0 crashes and is respawned
+        yield mocker.Mock(si_pid=101, si_code=os.CLD_EXITED, si_status=1)
+        # worker 1 exits cleanly
+        yield mocker.Mock(si_pid=102, si_code=os.CLD_EXITED, si_status=0)
+        assert f.workers == {103: 0}
+        f._signal_children(signal.SIGTERM, None)
+        yield mocker.Mock(si_pid=103, si_code=os.CLD_KILLED, si_status=15)
+
+    exit_iter = exits()
+    mocker.patch("os.waitid", side_effect=lambda *args: next(exit_iter))
+    f.run(lambda: None)
+
+    assert mock_fork.call_count == 3
+    assert f.stopping
+    assert f.workers == {}
+    # handlers are restored
+    assert signal.getsignal(signal.SIGTERM) is not f._signal_children
+
+
+def test_forked_crash_loop(mocker):
+    import itertools
+    import os
+
+    from buvar import fork
+
+    mocker.patch("os.getpgid", return_value=2)
+    pids = itertools.count(100)
+    mock_fork = mocker.patch("os.fork", side_effect=lambda: next(pids))
+    f = fork.Fork(2, backoff=0, max_restarts=2)
+
+    def waitid(*args):
+        # always the oldest child crashes
+        return mocker.Mock(si_pid=min(f.workers), si_code=os.CLD_EXITED, si_status=1)
+
+    mocker.patch("os.waitid", side_effect=waitid)
+    f.run(lambda: None)
+
+    # 2 workers, each restarted twice
+    assert mock_fork.call_count == 6
+    assert f.workers == {}
+    # given up workers are not reported anymore
+    assert f.status == {}
+    assert f.channels == {}
+    assert f.aggregate()["workers"] == 0
+
+
+def test_forked_always_clean_exits(mocker):
+    import itertools
+    import os
+    import signal
+
+    from buvar import fork, plugin
+
+    mocker.patch("os.getpgid", return_value=2)
+    mocker.patch("os.kill")
+    pids = itertools.count(100)
+    mock_fork = mocker.patch("os.fork", side_effect=lambda: next(pids))
+    f = fork.Fork(2, restart=plugin.Restart.ALWAYS, backoff=0, max_restarts=2)
+
+    def waitid(*args):
+        # clean exits are no crash loop
+        if mock_fork.call_count == 10:
+            f._signal_children(signal.SIGTERM, None)
+        return mocker.Mock(si_pid=min(f.workers), si_code=os.CLD_EXITED, si_status=0)
+
+    mocker.patch("os.waitid", side_effect=waitid)
+    f.run(lambda: None)
+
+    assert mock_fork.call_count == 10
 
 
 def test_forked_child(mocker):
@@ -45,3 +134,377 @@ def test_forked_no_fork(mocker):
 
     f.run(stuff, 1, 2)
     assert stuff_args == {1: 2}
+
+
+def test_stage_preload(mocker):
+    import gc
+
+    from buvar import context, fork, plugin
+
+    calls = []
+
+    class Foo:
+        pass
+
+    async def prepare_preload(teardown: plugin.Teardown):
+        calls.append("preload")
+        context.add(Foo())
+
+        async def close():
+            calls.append("teardown")
+
+        teardown.add(close())
+
+    async def prepare(load: plugin.Loader):
+        # already loaded in the parent
+        await load(prepare_preload)
+        foo = context.get(Foo)
+
+        async def task():
+            calls.append("task")
+            return foo
+
+        yield task()
+
+    freeze = mocker.spy(gc, "freeze")
+    result = fork.stage(prepare, forks=1, preload=[prepare_preload])
+
+    assert calls == ["preload", "task", "teardown"]
+    assert freeze.call_count == 1
+    assert isinstance(result[0], Foo)
+
+
+def test_stage_forked_tasks_finish():
+    import os
+    import time
+
+    from buvar import context, fork
+
+    parent = os.getpid()
+
+    async def prepare():
+        f = context.get(fork.Fork)
+
+        async def task():
+            return f.worker
+
+        yield task()
+
+    start = time.monotonic()
+    result = fork.stage(prepare, forks=2)
+    if os.getpid() != parent:
+        os._exit(0)
+
+    assert time.monotonic() - start < 5
+    assert sorted(result) == [[0], [1]]
+
+
+def test_preload_no_tasks():
+    import pytest
+
+    from buvar import fork
+
+    async def prepare():
+        yield None
+
+    with pytest.raises(RuntimeError):
+        fork.Preload(prepare)
+
+
+def test_forked_results_channel():
+    import os
+
+    from buvar import fork
+
+    f = fork.Fork(2)
+
+    def work():
+        f.stats["requests"] = f.worker + 1
+        f.send("stats", f.stats)
+        return f.worker
+
+    result = f.run(work)
+    if f.is_child:
+        os._exit(0)
+
+    assert sorted(result) == [0, 1]
+    assert f.aggregate() == {"workers": 2, "ready": 0, "requests": 3}
+    assert f.channels == {}
+
+
+async def test_report_status():
+    import asyncio
+
+    from buvar import fork, plugin
+
+    f = fork.Fork(1, status_interval=0.01)
+    f.stats["requests"] = 5
+    lifecycle = plugin.Lifecycle()
+
+    task = asyncio.create_task(f.report_status(lifecycle))
+    await asyncio.sleep(0)
+    assert f.status == {}
+
+    lifecycle.set(plugin.State.READY)
+    await asyncio.sleep(0.03)
+    lifecycle.set(plugin.State.DRAINING)
+    await task
+
+    status = f.status[None]
+    assert status.ready
+    assert status.stats["requests"] == 5
+    assert status.stats["rss"] > 0
+    assert f.aggregate()["ready"] == 1
+
+
+def test_forked_rolling_reload():
+    import os
+    import signal
+    import time
+
+    from buvar import fork
+
+    f = fork.Fork(2, status_interval=0.01, report_ready=True)
+    # as if SIGHUP was received
+    f.reloading = True
+
+    def work():
+        stop = []
+        signal.signal(signal.SIGINT, lambda *args: stop.append(args))
+        f.send("ready")
+        if f.worker == 3:
+            # the last new worker stops all
+            os.kill(f.ppid, signal.SIGINT)
+        deadline = time.monotonic() + 5
+        while not stop and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return f.worker, bool(stop)
+
+    result = f.run(work)
+    if f.is_child:
+        os._exit(0)
+
+    assert sorted(result) == [(0, True), (1, True), (2, True), (3, True)]
+    # the first old worker slot is retired, the second one may be stopped
+    # as well by the stop signal
+    assert {2, 3} <= set(f.status)
+    assert 0 not in f.status
+
+
+def test_forked_rolling_reload_old_worker_crashes(mocker):
+    import os
+    import signal
+
+    from buvar import fork
+
+    mocker.patch("os.getpgid", return_value=2)
+    mocker.patch("os.kill")
+    mock_fork = mocker.patch("os.fork", side_effect=[100, 101, 102, 103])
+    f = fork.Fork(2, backoff=0, report_ready=True)
+    f.reloading = True
+
+    def exits():
+        # the old worker crashes, while its replacement is not ready yet
+        assert f.workers == {100: 0, 101: 1, 102: 2}
+        yield mocker.Mock(si_pid=100, si_code=os.CLD_EXITED, si_status=1)
+        # the old worker is not respawned, the next one is replaced
+        assert f.workers == {101: 1, 102: 2, 103: 3}
+        assert 0 not in f.status
+        f._signal_children(signal.SIGTERM, None)
+        for pid in (101, 102, 103):
+            yield mocker.Mock(si_pid=pid, si_code=os.CLD_KILLED, si_status=15)
+
+    exit_iter = exits()
+    mocker.patch("os.waitid", side_effect=lambda *args: next(exit_iter))
+    f.run(lambda: None)
+
+    assert mock_fork.call_count == 4
+    assert f.workers == {}
+
+
+def test_forked_rolling_reload_without_ready():
+    import os
+    import signal
+    import time
+
+    from buvar import fork
+
+    f = fork.Fork(2, reload_timeout=30)
+    f.reloading = True
+
+    def work():
+        stop = []
+        signal.signal(signal.SIGINT, lambda *args: stop.append(args))
+        if f.worker == 3:
+            os.kill(f.ppid, signal.SIGINT)
+        deadline = time.monotonic() + 5
+        while not stop and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return f.worker, bool(stop)
+
+    start = time.monotonic()
+    result = f.run(work)
+    if f.is_child:
+        os._exit(0)
+
+    # the new workers are ready without reporting it
+    assert time.monotonic() - start < 5
+    assert sorted(result) == [(0, True), (1, True), (2, True), (3, True)]
+
+
+def test_parse_cpulist():
+    from buvar import fork
+
+    assert fork.parse_cpulist("0-3,8,10-11\n") == {0, 1, 2, 3, 8, 10, 11}
+    assert fork.parse_cpulist("") == set()
+
+
+def test_cpu_affinity(tmp_path, mocker):
+    import pytest
+
+    from buvar import fork
+
+    cpus = [0, 1, 2, 3]
+    assert fork.cpu_affinity("cpu", 5, cpus) == {1}
+    assert fork.cpu_affinity(lambda worker, cpus: cpus[:worker], 2, cpus) == {0, 1}
+
+    for node, cpulist in enumerate(("0-1", "2-3")):
+        (tmp_path / f"node{node}").mkdir()
+        (tmp_path / f"node{node}" / "cpulist").write_text(cpulist)
+    (tmp_path / "possible").write_text("0-1")
+    nodes = fork.numa_nodes(str(tmp_path))
+    assert nodes == [{0, 1}, {2, 3}]
+
+    mocker.patch.object(fork, "numa_nodes", return_value=nodes)
+    assert fork.cpu_affinity("node", 3, cpus) == {2, 3}
+    # only available CPUs
+    assert fork.cpu_affinity("node", 1, [0, 1]) == {0, 1}
+    # no NUMA
+    fork.numa_nodes.return_value = []
+    assert fork.cpu_affinity("node", 1, cpus) == set(cpus)
+
+    with pytest.raises(ValueError):
+        fork.cpu_affinity("foo", 0, cpus)
+
+
+def test_forked_pinned():
+    import os
+
+    from buvar import fork
+
+    f = fork.Fork(2, affinity="cpu")
+
+    def work():
+        return f.worker, f.cpus, os.sched_getaffinity(0)
+
+    result = f.run(work)
+    if f.is_child:
+        os._exit(0)
+
+    cpus = sorted(os.sched_getaffinity(0))
+    assert sorted(result) == [
+        (worker, {cpus[worker % len(cpus)]}, {cpus[worker % len(cpus)]})
+        for worker in range(2)
+    ]
+    assert [f.status[worker].cpus for worker in range(2)] == [
+        {cpus[worker % len(cpus)]} for worker in range(2)
+    ]
+
+
+def test_forked_rolling_reload_keeps_cpus():
+    import os
+    import signal
+    import time
+
+    from buvar import fork
+
+    slots = []
+
+    def affinity(cpu_slot, cpus):
+        slots.append(cpu_slot)
+        return {cpus[0]}
+
+    f = fork.Fork(2, affinity=affinity)
+    f.reloading = True
+
+    def work():
+        stop = []
+        signal.signal(signal.SIGINT, lambda *args: stop.append(args))
+        if f.worker == 3:
+            os.kill(f.ppid, signal.SIGINT)
+        deadline = time.monotonic() + 5
+        while not stop and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return f.worker, f.cpu_slot
+
+    result = f.run(work)
+    if f.is_child:
+        os._exit(0)
+
+    # the new workers take over the CPUs of the replaced ones
+    assert sorted(result) == [(0, 0), (1, 1), (2, 0), (3, 1)]
+    assert slots == [0, 1, 0, 1]
+
+
+def test_shared_state():
+    import asyncio
+
+    import pytest
+
+    from buvar import fork
+
+    state = fork.SharedState(6)
+    requests = state.counter("requests")
+    assert requests.add() == 1
+    assert requests.add(2) == 3
+    assert state.counter("requests").value == 3
+
+    inflight = state.gauge("inflight")
+    inflight.set(1.5)
+    assert inflight.add(-0.5) == 1.0
+
+    with pytest.raises(ValueError):
+        state.gauge("requests")
+
+    bucket = state.token_bucket("api", rate=10, capacity=2)
+    assert bucket.acquire(2)
+    assert not bucket.acquire()
+    assert 0 < bucket.delay() <= 0.1
+
+    assert state.values() == {
+        "requests": 3,
+        "inflight": 1.0,
+        "api": pytest.approx(0, abs=0.5),
+    }
+    # all processes share the same limit
+    assert state.token_bucket("api", rate=10, capacity=2).rate == 10
+    with pytest.raises(ValueError):
+        state.token_bucket("api", rate=1000, capacity=2)
+    asyncio.run(bucket.wait())
+    # a bucket occupies four slots
+    with pytest.raises(ValueError):
+        state.counter("full")
+    state.close()
+
+
+def test_forked_shared_state():
+    import os
+
+    from buvar import fork
+
+    state = fork.SharedState()
+    f = fork.Fork(4)
+
+    def work():
+        counter = state.counter("counter")
+        for _ in range(100):
+            counter.add()
+        return state.token_bucket("api", rate=0, capacity=2).acquire()
+
+    result = f.run(work)
+    if f.is_child:
+        os._exit(0)
+
+    assert state.counter("counter").value == 400
+    assert sorted(result) == [False, False, True, True]
+    state.close()
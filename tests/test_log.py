@@ -52,3 +52,166 @@ def _test_simple_structlog_json(capsys, mocker, caplog):
             "logger": "foobar",
         },
     ]
+
+
+@pytest.mark.parametrize(
+    "overflow, messages, dropped",
+    [
+        ("drop-new", ["0", "1"], 2),
+        ("drop-oldest", ["2", "3"], 2),
+        ("block", ["0", "1"], 0),
+    ],
+)
+def test_overflow_queue_handler(overflow, messages, dropped):
+    import logging
+    import queue
+    import threading
+
+    from buvar import log
+
+    q = queue.Queue(2)
+    handler = log.OverflowQueueHandler(q, overflow)
+    records = [
+        logging.LogRecord("foo", logging.INFO, __file__, 1, "%s", (i,), None)
+        for i in range(4)
+    ]
+    if overflow == "block":
+        threading.Timer(0.05, lambda: [q.get(), q.get()]).start()
+    for record in records[:2] if overflow == "block" else records:
+        handler.emit(record)
+
+    assert [record.msg for record in q.queue] == messages
+    assert handler.dropped == dropped
+
+    with pytest.raises(ValueError):
+        log.OverflowQueueHandler(q, "foo")
+
+
+def test_log_config_queue(mocker, capsys):
+    import logging
+
+    from buvar import log
+
+    mocker.patch("sys.excepthook")
+    mocker.patch("structlog.configure")
+    root = logging.getLogger()
+    mocker.patch.object(root, "handlers", [])
+    mocker.patch.object(root, "level")
+
+    log_config = log.LogConfig(tty=False, queue_size=10, capture_warnings=False)
+    log_config.setup()
+    assert root.handlers == [log_config.queue_handler]
+    assert log_config.listener._thread is not None
+
+    logging.getLogger("foobar").info("message: %s", 123)
+    log_config.stop()
+
+    assert log_config.listener is None
+    assert [type(handler) for handler in root.handlers] == [logging.StreamHandler]
+    assert "message: 123" in capsys.readouterr().err
+
+
+@pytest.mark.asyncio
+async def test_log_prepare_flush(mocker):
+    import logging
+
+    from buvar import context, log, plugin
+
+    mocker.patch("sys.excepthook")
+    mocker.patch("structlog.configure")
+    root = logging.getLogger()
+    mocker.patch.object(root, "handlers", [])
+    mocker.patch.object(root, "level")
+
+    log_config = log.LogConfig(tty=False, queue_size=10, capture_warnings=False)
+    log_config.setup()
+    teardown = plugin.Teardown()
+    with context.child():
+        context.add(log_config)
+        await log.prepare(teardown)
+    assert [entry.name for entry in teardown.entries] == ["log"]
+
+    await teardown.wait()
+    assert log_config.listener is None
+
+
+def test_log_config_queue_forked(mocker, tmp_path):
+    import logging
+    import os
+    import signal
+
+    from buvar import log
+
+    mocker.patch("sys.excepthook")
+    mocker.patch("structlog.configure")
+    root = logging.getLogger()
+    mocker.patch.object(root, "handlers", [])
+    mocker.patch.object(root, "level")
+
+    path = tmp_path / "log.json"
+    log_config = log.LogConfig(
+        tty=False,
+        queue_size=5,
+        capture_warnings=False,
+        user_config={
+            "handlers": {
+                "default": {"class": "logging.FileHandler", "filename": str(path)}
+            }
+        },
+    )
+    log_config.setup()
+
+    pid = os.fork()
+    if not pid:
+        try:
+            signal.alarm(5)
+            for i in range(20):
+                logging.getLogger("child").info("record %s", i)
+            log_config.stop()
+        finally:
+            os._exit(0)
+
+    _, status = os.waitpid(pid, 0)
+    log_config.stop()
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert path.read_text().count("record") == 20
+
+
+def test_log_config_queue_forked_once(mocker):
+    import logging
+    import os
+    import threading
+
+    from buvar import log
+
+    mocker.patch("sys.excepthook")
+    mocker.patch("structlog.configure")
+    root = logging.getLogger()
+    mocker.patch.object(root, "handlers", [])
+    mocker.patch.object(root, "level")
+
+    first = log.LogConfig(tty=False, queue_size=5, capture_warnings=False)
+    first.setup()
+    first.stop()
+    log_config = log.LogConfig(tty=False, queue_size=5, capture_warnings=False)
+    log_config.setup()
+    log_config.setup()
+
+    pid = os.fork()
+    if not pid:
+        # only the active queue has a listener thread
+        os._exit(threading.active_count())
+
+    _, status = os.waitpid(pid, 0)
+    log_config.stop()
+    assert first.listener is None
+    assert os.waitstatus_to_exitcode(status) == 2
+
+
+def test_log_config_schema():
+    from buvar import config, log
+
+    help = config.ConfigSchema({"log": log.LogConfig}, env_prefix="APP").env_help()
+    assert "APP_LOG_QUEUE_SIZE" in help.split()
+    assert "APP_LOG_QUEUE_HANDLER" not in help.split()
+    assert "APP_LOG_LISTENER" not in help.split()
@@ -0,0 +1,112 @@
+import pytest
+
+
+def test_loop_config_asyncio():
+    import asyncio
+
+    from buvar import context, loop
+
+    new_loop = loop.LoopConfig(policy="asyncio", debug=True).new_event_loop()
+    try:
+        assert isinstance(new_loop, asyncio.AbstractEventLoop)
+        assert new_loop.get_debug()
+        assert isinstance(new_loop.get_task_factory(), context.StackingTaskFactory)
+    finally:
+        new_loop.close()
+
+
+def test_loop_config_unknown():
+    from buvar import loop
+
+    with pytest.raises(ValueError):
+        loop.LoopConfig(policy="foobar").factory
+
+
+def test_loop_config_dotted_name():
+    import asyncio
+
+    from buvar import loop
+
+    assert loop.LoopConfig(policy="asyncio:new_event_loop").factory is (
+        asyncio.new_event_loop
+    )
+
+
+def test_load_loop_config_from_env(mocker):
+    from buvar import loop
+
+    mocker.patch.dict("os.environ", {"BUVAR_LOOP_POLICY": "asyncio"})
+    assert loop.load_loop_config() == loop.LoopConfig(policy="asyncio")
+
+
+def test_load_loop_config_from_source():
+    from buvar import components, config, loop
+
+    cmps = components.Components()
+    cmps.add(config.ConfigSource({"loop": {"policy": "uvloop", "debug": "yes"}}))
+    assert loop.load_loop_config(cmps) == loop.LoopConfig(policy="uvloop", debug=True)
+
+
+def test_load_loop_config_env_prefix(mocker):
+    from buvar import components, config, loop
+
+    mocker.patch(
+        "os.environ", {"BUVAR_LOOP_POLICY": "asyncio", "APP_LOOP_DEBUG": "yes"}
+    )
+    cmps = components.Components()
+    cmps.add(config.ConfigSource({"loop": {"policy": "uvloop"}}, env_prefix="APP"))
+    assert loop.load_loop_config(cmps) == loop.LoopConfig(policy="asyncio", debug=True)
+
+
+def test_stage_loop_factory():
+    import asyncio
+
+    from buvar import plugin
+
+    loops = []
+
+    def loop_factory():
+        new_loop = asyncio.new_event_loop()
+        loops.append(new_loop)
+        return new_loop
+
+    async def loop_plugin():
+        async def task():
+            return asyncio.get_running_loop()
+
+        yield task()
+
+    result = plugin.stage(loop_plugin, loop_factory=loop_factory)
+    assert result == loops
+    assert loops[0].is_closed()
+
+
+def test_stage_loop_policy_from_env(mocker):
+    import pytest
+
+    from buvar import plugin
+
+    async def loop_plugin():
+        pass
+
+    mocker.patch.dict("os.environ", {"BUVAR_LOOP_POLICY": "foo"})
+    with pytest.raises(ValueError):
+        plugin.stage(loop_plugin)
+
+
+def test_stage_keeps_current_loop():
+    import asyncio
+
+    from buvar import plugin
+
+    async def loop_plugin():
+        pass
+
+    current = asyncio.new_event_loop()
+    asyncio.set_event_loop(current)
+    try:
+        plugin.stage(loop_plugin)
+        assert asyncio.get_event_loop() is current
+    finally:
+        asyncio.set_event_loop(None)
+        current.close()
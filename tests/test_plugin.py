@@ -255,3 +255,539 @@ def test_signal_cancel(Something):
         "cancel",
         Something(lambda x: isinstance(x, asyncio.CancelledError)),
     ]
+
+
+def test_plugin_info_cached():
+    from buvar import plugin
+
+    async def foo_plugin(load: plugin.Loader) -> None:
+        yield
+
+    info = plugin.plugin_info(foo_plugin)
+    assert plugin.plugin_info(foo_plugin) is info
+    assert info.hints == {"load": plugin.Loader}
+    assert info.is_async_gen
+
+
+def test_resolve_plugin_func_cached(mocker):
+    import importlib
+
+    from buvar import plugin
+
+    plugin.resolve_plugin_name.cache_clear()
+    import_module = mocker.spy(importlib, "import_module")
+    func = plugin.resolve_plugin_func("tests.foo_plugin")
+    assert plugin.resolve_plugin_func("tests.foo_plugin") is func
+    assert import_module.call_count == 1
+
+    # e.g. after a reload of the plugin module
+    plugin.resolve_plugin_name.cache_clear()
+    assert plugin.resolve_plugin_func("tests.foo_plugin") is func
+    assert import_module.call_count == 2
+
+
+def test_plugin_args_from_adapters(adapters):
+    from buvar import di, plugin
+
+    class Foo:
+        pass
+
+    def adapt() -> Foo:
+        return Foo()
+
+    di.register(adapt)
+    state = {}
+
+    async def foo_plugin(foo: Foo):
+        state["foo"] = foo
+
+    plugin.stage(foo_plugin)
+    assert isinstance(state["foo"], Foo)
+
+
+def test_plugin_args_missing():
+    from buvar import ComponentLookupError, plugin
+
+    class Foo:
+        pass
+
+    async def foo_plugin(foo: Foo):
+        pass
+
+    with pytest.raises(ComponentLookupError):
+        plugin.stage(foo_plugin)
+
+
+def test_discover_plugins(mocker, tmp_path):
+    import importlib.metadata
+
+    from buvar import plugin
+
+    eps = importlib.metadata.EntryPoints(
+        [
+            importlib.metadata.EntryPoint(
+                "foo", "tests.foo_plugin", plugin.PLUGIN_ENTRY_POINT_GROUP
+            ),
+            importlib.metadata.EntryPoint(
+                "bar", "tests.bar_plugin:plugin_bar", plugin.PLUGIN_ENTRY_POINT_GROUP
+            ),
+        ]
+    )
+    entry_points = mocker.patch("importlib.metadata.entry_points", return_value=eps)
+    index = str(tmp_path / "plugins.json")
+
+    plugins = plugin.discover_plugins(index=index)
+    assert plugins == {"bar": "tests.bar_plugin:plugin_bar", "foo": "tests.foo_plugin"}
+    entry_points.assert_called_once_with(group=plugin.PLUGIN_ENTRY_POINT_GROUP)
+
+    # cached in index, without reading any distribution metadata
+    distributions = mocker.spy(importlib.metadata, "distributions")
+    assert plugin.discover_plugins(index=index) == plugins
+    assert entry_points.call_count == 1
+    assert distributions.call_count == 0
+
+    # distributions changed
+    mocker.patch("buvar.plugin.distributions_key", return_value=[["foo", 1]])
+    assert plugin.discover_plugins(index=index) == plugins
+    assert entry_points.call_count == 2
+
+
+def test_distributions_key(mocker, tmp_path):
+    import importlib.metadata
+    import os
+
+    from buvar import plugin
+
+    (tmp_path / "foo-1.0.dist-info").mkdir()
+    entry_points = tmp_path / "foo-1.0.dist-info" / "entry_points.txt"
+    entry_points.write_text("[buvar.plugins]\n")
+    os.utime(entry_points, ns=(1, 1))
+    (tmp_path / "bar-0.1.egg-info").mkdir()
+    (tmp_path / "foo").mkdir()
+    mocker.patch("sys.path", [str(tmp_path), str(tmp_path / "missing")])
+    distributions = mocker.spy(importlib.metadata, "distributions")
+
+    assert plugin.distributions_key() == [
+        [str(tmp_path / "bar-0.1.egg-info"), None],
+        [str(entry_points.parent), 1],
+    ]
+    # an editable install changed its entry points
+    os.utime(entry_points, ns=(2, 2))
+    assert plugin.distributions_key()[1] == [str(entry_points.parent), 2]
+    assert distributions.call_count == 0
+
+
+def test_stage_discover(mocker):
+    from buvar import plugin
+
+    discover = mocker.patch(
+        "buvar.plugin.discover_plugins", return_value={"foo": "tests.foo_plugin"}
+    )
+    assert plugin.stage(discover=True) == [{"foo": "foo"}, None, None]
+    discover.assert_called_once_with()
+
+
+def test_supervised_restart_on_failure():
+    from buvar import plugin
+
+    state = {"runs": 0}
+
+    async def flaky():
+        state["runs"] += 1
+        if state["runs"] < 3:
+            raise Exception("flaky")
+        return "flaky"
+
+    async def flaky_plugin():
+        yield plugin.Supervised(flaky, backoff=0)
+
+    result = plugin.stage(flaky_plugin, cancel_timeout=0.1)
+    assert result == ["flaky"]
+    assert state == {"runs": 3}
+
+
+def test_supervised_crash_loop(Something):
+    from buvar import plugin
+
+    class MyException(Exception): ...
+
+    supervised = {}
+
+    async def broken():
+        raise MyException()
+
+    async def broken_plugin():
+        supervised["task"] = plugin.Supervised(broken, backoff=0, max_restarts=2)
+        yield supervised["task"]
+
+    result = plugin.stage(broken_plugin, cancel_timeout=0.1)
+    assert result == [Something(lambda x: isinstance(x, MyException))]
+    assert supervised["task"].restarts == 2
+
+
+def test_supervised_critical(Something):
+    import asyncio
+
+    from buvar import plugin
+
+    async def critical():
+        await asyncio.sleep(0)
+        return "critical"
+
+    async def server_plugin(cancel: plugin.Cancel):
+        async def server():
+            await cancel.wait()
+            return "server"
+
+        yield plugin.Supervised(critical, restart=plugin.Restart.NEVER, critical=True)
+        yield server()
+
+    result = plugin.stage(server_plugin, cancel_timeout=0.1)
+    assert result == ["critical", "server"]
+
+
+def test_supervised_always_until_cancel():
+    import asyncio
+
+    from buvar import plugin
+
+    state = {"runs": 0}
+
+    async def always_plugin(cancel: plugin.Cancel):
+        async def job():
+            state["runs"] += 1
+            await asyncio.sleep(0)
+            if state["runs"] == 10:
+                cancel.set()
+            return state["runs"]
+
+        # INFO: successful runs do not count as crash loop
+        yield plugin.Supervised(
+            job, restart=plugin.Restart.ALWAYS, backoff=0, max_restarts=2
+        )
+
+    result = plugin.stage(always_plugin, cancel_timeout=0.1)
+    assert result == [10]
+
+
+@pytest.mark.asyncio
+async def test_run_shutdown_durations(components):
+    import asyncio
+
+    from buvar import plugin
+
+    cancel = plugin.Cancel()
+
+    async def cancel_task():
+        await asyncio.sleep(0)
+        cancel.set()
+        return "cancel"
+
+    async def slow_task():
+        await cancel.wait()
+        await asyncio.sleep(0.01)
+        return "slow"
+
+    async def ungraceful_task():
+        await asyncio.Future()
+
+    result = await plugin.run(
+        [cancel_task(), slow_task(), ungraceful_task()],
+        evt_cancel=cancel,
+        cancel_timeout=0.1,
+    )
+    assert result[:2] == ["cancel", "slow"]
+    assert isinstance(result[2], asyncio.CancelledError)
+
+    stage_tasks = components.get(plugin.Tasks)
+    cancel_t, slow_t, ungraceful_t = stage_tasks
+    assert stage_tasks.durations.get(cancel_t, 0) < 0.01
+    assert 0.01 <= stage_tasks.durations[slow_t] < 0.1
+    assert stage_tasks.durations[ungraceful_t] >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_run_no_tasks():
+    from buvar import plugin
+
+    assert await plugin.run([], evt_cancel=plugin.Cancel()) == []
+
+
+@pytest.mark.asyncio
+async def test_teardown_phases():
+    import asyncio
+
+    from buvar import plugin
+
+    order = []
+
+    async def close(name):
+        await asyncio.sleep(0)
+        order.append(name)
+
+    teardown = plugin.Teardown()
+    teardown.add(close("db"), phase=1)
+    teardown.add(close("server"))
+    teardown.add(close("client"))
+    teardown.add(close("log"), phase=2)
+
+    report = await teardown.wait()
+    assert order[:2] in (["server", "client"], ["client", "server"])
+    assert order[2:] == ["db", "log"]
+    assert [entry.phase for entry in report] == [0, 0, 1, 2]
+    assert not any(entry.timed_out or entry.error for entry in report)
+
+
+@pytest.mark.asyncio
+async def test_teardown_deadline(log_output):
+    import asyncio
+
+    from buvar import plugin
+
+    class MyException(Exception): ...
+
+    async def hang():
+        await asyncio.Future()
+
+    async def broken():
+        raise MyException()
+
+    async def close():
+        pass
+
+    teardown = plugin.Teardown(timeout=1.0)
+    teardown.add(hang(), timeout=0.01, name="hang")
+    teardown.add(broken())
+    teardown.add(close())
+
+    hung, failed, closed = await teardown.wait()
+    assert hung.timed_out and hung.duration < 1.0
+    assert isinstance(failed.error, MyException)
+    assert not closed.timed_out and closed.error is None
+    assert {
+        "event": "Teardown timed out",
+        "teardown": hung,
+        "log_level": "warning",
+    } in log_output.entries
+
+
+def test_drain_in_flight():
+    import asyncio
+
+    from buvar import plugin
+
+    states = []
+
+    async def drain_plugin(cancel: plugin.Cancel, lifecycle: plugin.Lifecycle):
+        async def request():
+            with lifecycle.in_flight():
+                await lifecycle.wait(plugin.State.DRAINING)
+                assert not lifecycle.accepting
+                states.append(lifecycle.state)
+                await asyncio.sleep(0.01)
+            return "request"
+
+        async def server():
+            await lifecycle.wait(plugin.State.READY)
+            states.append(lifecycle.state)
+            cancel.set()
+            await lifecycle.wait(plugin.State.STOPPING)
+            states.append(lifecycle.state)
+            return "server"
+
+        yield request()
+        yield server()
+
+    result = plugin.stage(drain_plugin, cancel_timeout=1)
+    assert result == ["request", "server"]
+    assert states == [plugin.State.READY, plugin.State.DRAINING, plugin.State.STOPPING]
+
+
+def test_drain_timeout(Something):
+    import asyncio
+
+    from buvar import plugin
+
+    async def drain_plugin(cancel: plugin.Cancel, lifecycle: plugin.Lifecycle):
+        async def request():
+            with lifecycle.in_flight():
+                cancel.set()
+                await asyncio.Future()
+
+        yield request()
+
+    result = plugin.stage(drain_plugin, cancel_timeout=0.1)
+    assert result == [Something(lambda x: isinstance(x, asyncio.CancelledError))]
+
+
+def test_stage_closes_owned_loop():
+    import asyncio
+
+    from buvar import plugin
+
+    async def task_plugin():
+        async def task():
+            return "task"
+
+        yield task()
+
+    stage = plugin.Stage()
+    assert stage.run(task_plugin) == ["task"]
+    assert stage.loop.is_closed()
+
+    with plugin.Stage() as stage:
+        stage.load(task_plugin)
+    assert stage.loop.is_closed()
+
+    loop = asyncio.new_event_loop()
+    try:
+        plugin.Stage(loop=loop).run(task_plugin)
+        assert not loop.is_closed()
+    finally:
+        loop.close()
+
+
+def test_threads():
+    import asyncio
+    import threading
+
+    from buvar import Components, context, plugin
+
+    cmps = Components()
+    shared = cmps.add({"shared": True})
+
+    async def thread_plugin():
+        context.add(threading.current_thread().name, name="thread")
+
+        async def task():
+            assert context.get(dict) is shared
+            return (
+                context.get(str, name="thread"),
+                asyncio.get_running_loop(),
+            )
+
+        yield task()
+
+    f = plugin.Threads(2)
+    results = f.run(thread_plugin, components=cmps)
+    assert len(results) == 2
+    (thread_1, loop_1), (thread_2, loop_2) = (result for (result,) in results)
+    assert thread_1 != thread_2
+    assert loop_1 is not loop_2
+    assert all(stage.loop.is_closed() for stage in f.stages)
+
+
+def test_threads_preload():
+    import asyncio
+
+    from buvar import context, plugin
+
+    calls = []
+
+    class Big:
+        pass
+
+    async def preload_plugin(teardown: plugin.Teardown):
+        calls.append("preload")
+        context.add(Big())
+
+        async def close():
+            calls.append("teardown")
+
+        teardown.add(close())
+
+    async def thread_plugin(load: plugin.Loader):
+        # already loaded once for all threads
+        await load(preload_plugin)
+        big = context.get(Big)
+
+        async def task():
+            return big
+
+        yield task()
+
+    current = asyncio.new_event_loop()
+    asyncio.set_event_loop(current)
+    try:
+        results = plugin.Threads(2).run(thread_plugin, preload=[preload_plugin])
+        # the current loop of the main thread is kept
+        assert asyncio.get_event_loop() is current
+    finally:
+        asyncio.set_event_loop(None)
+        current.close()
+    (big_1,), (big_2,) = results
+    assert isinstance(big_1, Big) and big_1 is big_2
+    assert calls == ["preload", "teardown"]
+
+
+def test_threads_cancel():
+    import asyncio
+    import threading
+
+    from buvar import plugin
+
+    threads = plugin.Threads(2)
+    ready = threading.Barrier(3)
+
+    async def server_plugin(cancel: plugin.Cancel):
+        async def server():
+            await asyncio.to_thread(ready.wait)
+            await cancel.wait()
+            return "server"
+
+        yield server()
+
+    canceller = threading.Thread(target=lambda: (ready.wait(), threads.cancel()))
+    canceller.start()
+    results = threads.run(server_plugin, cancel_timeout=1)
+    canceller.join()
+    assert results == [["server"], ["server"]]
+
+
+def test_threads_cancel_before_start():
+    import asyncio
+
+    from buvar import plugin
+
+    threads = plugin.Threads(2)
+
+    def loop_factory():
+        # the stage of this thread is not created yet
+        threads.cancel()
+        return asyncio.new_event_loop()
+
+    async def server_plugin(cancel: plugin.Cancel):
+        async def server():
+            await cancel.wait()
+            return "server"
+
+        yield server()
+
+    results = threads.run(server_plugin, loop_factory=loop_factory, cancel_timeout=1)
+    assert results == [["server"], ["server"]]
+    assert all(stage.loop.is_closed() for stage in threads.stages)
+    # a closed loop is skipped
+    threads.cancel()
+
+    with pytest.raises(TypeError):
+        threads.run(server_plugin, signals=plugin.Signals)
+
+
+def test_threads_stage_failed():
+    import threading
+
+    from buvar import plugin
+
+    async def server_plugin(cancel: plugin.Cancel):
+        if threading.current_thread().name == "buvar-stage-0":
+            raise ValueError("broken")
+
+        async def server():
+            await cancel.wait()
+            return "server"
+
+        yield server()
+
+    results = plugin.Threads(2).run(server_plugin, cancel_timeout=1)
+    assert isinstance(results[0], ValueError)
+    assert results[1] == ["server"]
@@ -60,3 +60,263 @@ def test_bind_sockets(Anything):
     with fork.Sockets("tcp://:0").bind() as sockets:
         s = next(iter(sockets.values()))
         assert s.getsockname() == ("0.0.0.0", Anything)
+
+
+def test_tcp_socket_options():
+    from buvar import fork
+
+    s = fork.Socket("tcp://:12345?reuseport=1")
+    assert str(s) == "tcp://0.0.0.0:12345?reuseport=1"
+    assert s.options == {"reuseport": "1"}
+    assert s.reuseport
+    assert not fork.Socket("tcp://:12345").reuseport
+
+
+def test_reuseport_for_worker():
+    import socket
+
+    from buvar import fork
+
+    with fork.Sockets("tcp://127.0.0.1:0?reuseport=1&incoming_cpu=1").bind() as s:
+        (parent,) = s.values()
+        address = parent.getsockname()
+
+        worker_sockets = s.for_worker(0)
+        (worker,) = worker_sockets.values()
+        try:
+            assert worker is not parent
+            assert parent.fileno() == -1
+            assert worker.getsockname() == address
+            assert worker.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT)
+            assert worker.getsockopt(
+                socket.SOL_SOCKET, fork.SO_INCOMING_CPU
+            ) == fork.worker_cpu(0)
+        finally:
+            worker.close()
+
+
+def test_incoming_cpu_not_supported(mocker):
+    from buvar import fork
+
+    mocker.patch.object(fork, "SO_INCOMING_CPU", None)
+    warning = mocker.patch.object(fork.sl, "warning")
+    with fork.Sockets("tcp://127.0.0.1:0?reuseport=1&incoming_cpu=1").bind() as s:
+        (worker,) = s.for_worker(0).values()
+        worker.close()
+    warning.assert_called_once_with(
+        "Socket option not supported", option="incoming_cpu", socket=worker
+    )
+
+
+def test_no_reuseport_for_worker():
+    from buvar import fork
+
+    with fork.Sockets("tcp://127.0.0.1:0").bind() as s:
+        assert s.for_worker(0) == s
+        assert all(a is b for a, b in zip(s.for_worker(0).values(), s.values()))
+
+
+def test_tcp_socket_tuning():
+    import socket
+
+    from buvar import fork
+
+    s = fork.Socket("tcp://127.0.0.1:0?backlog=1024&nodelay=1&sndbuf=65536")
+    s.bind()
+    try:
+        assert s.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        # the kernel doubles the buffer size
+        assert s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536
+        # already listening
+        assert s.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN)
+    finally:
+        s.close()
+
+
+def test_socket_listen_backlog(mocker):
+    import socket
+
+    from buvar import fork
+
+    listen = mocker.patch.object(socket.socket, "listen")
+    s = fork.Socket("tcp://127.0.0.1:0?backlog=1024")
+    try:
+        # servers may pass their own backlog
+        s.listen(100)
+        listen.assert_called_with(1024)
+        fork.Socket("tcp://127.0.0.1:0").listen(100)
+        listen.assert_called_with(100)
+    finally:
+        s.close()
+
+
+def test_socket_unknown_option():
+    from buvar import fork
+
+    with pytest.raises(ValueError):
+        fork.Socket("tcp://:0?foo=1")
+
+
+def test_unix_socket_mode_and_stale(tmp_path):
+    import os
+    import socket
+    import stat
+
+    from buvar import fork
+
+    path = tmp_path / "foo.sock"
+    # a stale socket file
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    assert path.exists()
+
+    with fork.Sockets(f"unix://{path}?mode=660").bind() as sockets:
+        (s,) = sockets.values()
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o660
+        assert s.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN) == 0
+
+    assert not path.exists()
+
+
+def test_unix_socket_no_socket_file(tmp_path):
+    from buvar import fork
+
+    path = tmp_path / "data.txt"
+    path.write_text("data")
+
+    with pytest.raises(FileExistsError):
+        with fork.Sockets(f"unix://{path}").bind():
+            pass
+
+    assert path.read_text() == "data"
+
+
+def test_tcp6_socket():
+    import socket
+
+    from buvar import fork
+
+    s = fork.Socket("tcp6://:0")
+    assert str(s) == "tcp6://[::]:0"
+    assert s.family == socket.AF_INET6
+    s.bind()
+    try:
+        # dual stack
+        assert not s.getsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY)
+        s.listen()
+        port = s.getsockname()[1]
+        with socket.create_connection(("127.0.0.1", port)):
+            pass
+    finally:
+        s.close()
+
+
+def test_udp_socket():
+    import socket
+
+    from buvar import fork
+
+    with fork.Sockets("udp://127.0.0.1:0").bind() as sockets:
+        (s,) = sockets.values()
+        assert s.type == socket.SOCK_DGRAM
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+            client.sendto(b"foo", s.getsockname())
+        assert s.recv(3) == b"foo"
+
+
+def test_udp_socket_no_backlog():
+    from buvar import fork
+
+    with pytest.raises(ValueError):
+        fork.Socket("udp://:0?backlog=10")
+
+
+def test_udp_socket_no_reuseport():
+    from buvar import fork
+
+    with pytest.raises(ValueError):
+        fork.Socket("udp://:0?reuseport=1")
+
+
+def test_udp_socket_forked():
+    import asyncio
+    import os
+    import socket
+    import threading
+    import time
+
+    from buvar import context, fork
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as free:
+        free.bind(("127.0.0.1", 0))
+        address = free.getsockname()
+    uri = "udp://{}:{}".format(*address)
+    parent = os.getpid()
+
+    async def prepare():
+        sock = context.get(fork.Socket, name=uri)
+        sock.setblocking(False)
+
+        async def task():
+            loop = asyncio.get_running_loop()
+            count = 0
+            while True:
+                try:
+                    await asyncio.wait_for(loop.sock_recv(sock, 16), 1)
+                except TimeoutError:
+                    return count
+                count += 1
+
+        yield task()
+
+    def send():
+        time.sleep(0.5)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+            for _ in range(300):
+                client.sendto(b"foo", address)
+                time.sleep(0.001)
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    result = fork.stage(prepare, forks=2, sockets=[uri])
+    if os.getpid() != parent:
+        os._exit(0)
+    sender.join()
+
+    assert sum(count for (count,) in result) == 300
+
+
+def test_listen_fds():
+    import os
+
+    from buvar import fork
+
+    environ = {
+        "LISTEN_PID": str(os.getpid()),
+        "LISTEN_FDS": "2",
+        "LISTEN_FDNAMES": "web:",
+    }
+    assert fork.listen_fds(environ) == {"web": 3, "4": 4}
+    assert fork.listen_fds({**environ, "LISTEN_PID": "1"}) == {}
+
+
+def test_fd_socket(mocker):
+    import os
+    import socket
+
+    from buvar import fork
+
+    listening = socket.create_server(("127.0.0.1", 0))
+    # as if inherited from a process manager
+    fd = os.dup(listening.fileno())
+    mocker.patch.object(fork, "listen_fds", return_value={"web": fd})
+    try:
+        with fork.Sockets("fd://web").bind() as sockets:
+            s = sockets["fd://web"]
+            assert s.fileno() == fd
+            assert s.family == socket.AF_INET
+            assert s.getsockname() == listening.getsockname()
+        assert s.fileno() == -1
+    finally:
+        listening.close()
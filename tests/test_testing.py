@@ -24,3 +24,10 @@ async def test_wrapped_stage_context_load(buvar_load):
     await buvar_load(prepare)
     assert context.get(str) == "foobar"
     assert context.get(plugin.Cancel)
+
+
+@pytest.mark.asyncio
+async def test_stage_loop(buvar_stage):
+    import asyncio
+
+    assert buvar_stage.loop is asyncio.get_running_loop()
@@ -33,3 +33,68 @@ def test_resolve_dotted_name_relative():
     func = util.resolve_dotted_name(".test_util:foo")
 
     assert func is foo
+
+
+def nested_config(depth, width, leaf=0):
+    if not depth:
+        return leaf
+    return {f"key{i}": nested_config(depth - 1, width, leaf) for i in range(width)}
+
+
+def test_merge_dict():
+    from buvar import util
+
+    a = {"foo": {"bar": 1, "baz": {"bim": 2}}, "x": 1}
+    b = {"foo": {"baz": {"bam": 3}}, "x": 2}
+    dest = util.merge_dict(a, b)
+    assert dest == {"foo": {"bar": 1, "baz": {"bim": 2, "bam": 3}}, "x": 2}
+    # copied
+    assert dest["foo"] is not a["foo"]
+    assert a == {"foo": {"bar": 1, "baz": {"bim": 2}}, "x": 1}
+
+
+def test_merge_dict_deep():
+    import sys
+
+    from buvar import util
+
+    deep = leaf = {}
+    for _ in range(sys.getrecursionlimit() * 2):
+        leaf = leaf.setdefault("a", {})
+    leaf["b"] = 1
+    dest = util.merge_dict(deep)
+    assert dest is not deep
+
+
+def test_merged_shares_subtrees():
+    from buvar import util
+
+    a = {"foo": {"bar": 1, "baz": {"bim": 2}}, "other": {"x": 1}}
+    b = {"foo": {"bar": 3}}
+    dest = util.merged(a, b)
+    assert dest == {"foo": {"bar": 3, "baz": {"bim": 2}}, "other": {"x": 1}}
+    assert dest["other"] is a["other"]
+    assert dest["foo"]["baz"] is a["foo"]["baz"]
+    # sources are untouched
+    assert a == {"foo": {"bar": 1, "baz": {"bim": 2}}, "other": {"x": 1}}
+    assert b == {"foo": {"bar": 3}}
+
+
+@pytest.mark.benchmark(group="merge")
+def test_merge_dict_benchmark(benchmark):
+    from buvar import util
+
+    base = nested_config(5, 6)
+    override = {"key0": {"key1": {"key2": {"key3": {"key4": 1}}}}}
+
+    benchmark(util.merge_dict, base, override)
+
+
+@pytest.mark.benchmark(group="merge")
+def test_merged_benchmark(benchmark):
+    from buvar import util
+
+    base = nested_config(5, 6)
+    override = {"key0": {"key1": {"key2": {"key3": {"key4": 1}}}}}
+
+    benchmark(util.merged, base, override)